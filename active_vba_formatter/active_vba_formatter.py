@@ -11,9 +11,18 @@
 # v1.0.7 exe化対応および終了処理の堅牢化
 # v1.0.8 UIメッセージの改善と終了確認の削除
 # v1.0.9 ポップアップバルーン修正(リリース最終版)
+# v1.1.0 --profile オプションによるプロファイル計測モード
+# v1.1.1 読み込み・整形・書き戻しのパイプライン化（整形の並列実行）
+# v1.1.2 COMコストモデルによる書き戻し方法の選択とベンチマークモード
+# v1.1.3 オートメーションバックエンドの切り替えとExcel/VBEシミュレーター
+# v1.1.4 常駐時のメモリ使用量削減（Tkの遅延生成、遅延インポート）とフットプリント計測
+# v1.1.5 手続き単位の構造インデックスと部分整形API、手続き単位の差分計算
+# v1.1.6 前回実行時のプローブ情報による、変更の無いモジュールの全文読み込みの省略
+# v1.1.7 保存時に変更のあったモジュールをvba_sourceへ書き出す同期エクスポート(--sync-export)
+# v1.1.8 同期エクスポートの文字コード指定(既定はシステムのANSIコードページ)と改行コードCRLF
 # ===================================================================================
 #
-# Version: 1.0.9
+# Version: 1.1.8
 #
 # 概要:
 #   バックグラウンドで常駐し、アクティブなExcelブックのVBAコードを
@@ -23,31 +32,44 @@
 #
 # 依存ライブラリ:
 #   pywin32, pystray, Pillow, psutil
+#   (環境変数 VBA_AUTOMATION_BACKEND=simulator の場合、pywin32無しで整形処理を実行可能)
 #
 # ===================================================================================
 
-import win32com.client
-import win32gui
-import win32process
-import psutil
 import os
 import time
-import pythoncom
-import difflib
 import sys
 import subprocess
 import threading
 import logging
+import argparse
+import io
 from logging.handlers import RotatingFileHandler
-from pystray import MenuItem as item
-import pystray
-from PIL import Image, ImageDraw
-import tkinter as tk
-from tkinter import messagebox
 import ctypes
-import pywintypes
-import winerror
-import win32event
+import codecs
+import locale
+import collections
+import json
+import re
+from typing import NamedTuple
+
+# psutil・pystray・Pillow・tkinterは、常駐プロセスや整形役サブプロセスで
+# 不要なモジュールを読み込まないよう、使用する関数の中でインポートする。
+# 同様に、整形役・計測でのみ使用するcProfile・pstats・concurrent.futures・difflib・
+# tempfile・bisect・zlibも、常駐プロセスでは読み込まない。
+
+try:
+    import win32com.client
+    import win32gui
+    import win32process
+    import pythoncom
+    import pywintypes
+    import winerror
+    import win32event
+except ImportError:
+    # Windows以外の環境（CIでのシミュレーター実行等）ではpywin32を利用できない
+    win32com = win32gui = win32process = pythoncom = None
+    pywintypes = winerror = win32event = None
 
 # ===================================================================================
 # 0. グローバル設定
@@ -80,6 +102,19 @@ def func_get_resource_path(relative_path):
     return os.path.join(base_path, relative_path)
 
 
+def func_get_ansi_code_page() -> str:
+    """
+    VBEがソースのインポート・エクスポートに使う、システムのANSIコードページを返す。
+    日本語環境ではcp932、英語環境ではcp1252となる。Windows以外ではロケールの文字コードを返す。
+    """
+    try:
+        encoding = f"cp{ctypes.windll.kernel32.GetACP()}"
+        codecs.lookup(encoding)
+        return encoding
+    except (AttributeError, OSError, LookupError):
+        return locale.getpreferredencoding(False)
+
+
 # --- 定数 ---
 CHECK_INTERVAL_SECONDS = 2
 INDENT_STRING = "    "
@@ -89,6 +124,22 @@ ICON_FILE_PATH = func_get_resource_path(
     ICON_FILE_NAME
 )  # バンドルされたリソースのパス解決
 LOG_FILE_PATH = os.path.join(BASE_DIR, "active_vba_formatter.log")
+PROFILE_FILE_PREFIX = "active_vba_formatter"
+PROFILE_TOP_N = 25  # --profile 時にログへ出力する上位関数の件数
+TRAY_ICON_SIZE = (64, 64)  # タスクトレイ用に縮小して保持するアイコンのサイズ
+FOOTPRINT_INTERVAL_SECONDS = 600  # --measure-footprint 時の記録間隔
+# 変更検知用プローブ（前回実行時のモジュールの行数とサンプル行）の設定
+PROBE_STATE_FILE_PATH = os.path.join(BASE_DIR, "active_vba_formatter_probe.json")
+PROBE_MAX_HEADER_SAMPLES = 8  # サンプルとして照合する手続き宣言行の最大数
+PROBE_FULL_VERIFY_EVERY = 10  # この回数に1回は全モジュールを全文読み込みで検証する
+# --sync-export 時の出力先（vba_exporterと同じ構成）とコンポーネントの種類ごとの拡張子
+SYNC_EXPORT_DIR = os.path.join(BASE_DIR, "vba_source")
+SYNC_COMPONENT_EXTENSIONS = {1: ".bas", 2: ".cls", 3: ".frm", 100: ".cls"}
+SYNC_EXPORT_ENCODING = func_get_ansi_code_page()  # VBEのインポート・エクスポートと同じ
+FORMAT_WORKERS = max(1, min(4, (os.cpu_count() or 1) - 1))  # 整形ワーカー数
+# 書き戻しコストモデルの既定係数（--com-call-ms / --com-line-ms で実測値に調整可能）
+COM_CALL_COST_MS = 1.5  # COM呼び出し1回あたりの固定コスト
+COM_LINE_COST_MS = 0.05  # 削除・挿入する1行あたりのコスト
 
 # --- グローバルロガー ---
 logger = logging.getLogger(__name__)
@@ -243,12 +294,138 @@ class Messages:
             return "起動しました。VBAコードの自動整形を開始します。"
         return "Started. Now monitoring VBA code for auto-formatting."
 
+    def profile_saved(self, f):
+        msg = "プロファイルを保存しました: {}"
+        if not self.is_jp:
+            msg = "Profile saved: {}"
+        return msg.format(f)
+
+    def profile_top_functions(self, n):
+        msg = "処理時間の長い上位 {} 関数:"
+        if not self.is_jp:
+            msg = "Top {} functions by internal time:"
+        return msg.format(n)
+
+    def apply_strategy(self, strategy, estimated_ms, actual_ms):
+        msg = "[方式: {}, 推定 {:.1f}ms / 実測 {:.1f}ms]"
+        if not self.is_jp:
+            msg = "[strategy: {}, estimated {:.1f}ms / actual {:.1f}ms]"
+        return msg.format(strategy, estimated_ms, actual_ms)
+
+    def footprint(self, values):
+        msg = "メモリ {rss_mb:.1f}MB / ハンドル {handles} / スレッド {threads} / モジュール {modules}"
+        if not self.is_jp:
+            msg = "RSS {rss_mb:.1f}MB / handles {handles} / threads {threads} / modules {modules}"
+        if "gdi" in values:
+            msg += " / GDI {gdi} / USER {user}"
+        return msg.format(**values)
+
+    def probe_summary(self, read_count, skipped_count):
+        msg = "全文を読み込んだモジュール: {} / 変更なしとしてスキップ: {}"
+        if not self.is_jp:
+            msg = "Modules read in full: {} / skipped as unchanged: {}"
+        return msg.format(read_count, skipped_count)
+
+    def sync_export_summary(self, folder, written, unchanged, failed):
+        msg = "同期エクスポート ({}): 書き込み {} / 変更なし {} / 失敗 {}"
+        if not self.is_jp:
+            msg = "Sync export ({}): written {} / unchanged {} / failed {}"
+        return msg.format(folder, written, unchanged, failed)
+
+    def sync_export_error(self, path):
+        if self.is_jp:
+            return f"同期エクスポートに失敗しました: {path}"
+        return f"Sync export failed: {path}"
+
+    def profile_error(self):
+        if self.is_jp:
+            return "プロファイル結果の保存に失敗しました。"
+        return "Failed to save the profile result."
+
 
 # ===================================================================================
 # 2. VBAコード整形クラス
 # ===================================================================================
+class VbaProcedure(NamedTuple):
+    """構造インデックス内の手続き（Sub/Function/Property）の情報。行番号は1始まり。"""
+
+    name: str
+    kind: str  # "sub" / "function" / "property"
+    start_line: int
+    end_line: int
+    indent_level: int  # 開始行を整形する時点のインデントレベル
+    block_depth: int  # 開始行を整形する時点のブロックのネスト数
+
+
+class VbaCheckpoint(NamedTuple):
+    """整形を途中の行から再開するために必要な状態。行番号は1始まり。"""
+
+    line: int  # 元コードの行番号
+    formatted_line: int  # 整形後のコードでの行番号
+    indent_level: int
+    block_stack: tuple
+    last_blank: bool  # 直前に出力した行が空行（またはモジュール先頭）か
+
+
+class VbaStructureIndex:
+    """
+    モジュールの構造インデックス。
+    手続きの範囲と開始時点のインデント状態、Select Caseの範囲、
+    および整形を途中から再開できる位置（チェックポイント）を保持する。
+    チェックポイントはモジュール先頭・各手続きの開始行・各手続きの終了直後の行に置かれる。
+    """
+
+    def __init__(self, line_count: int):
+        self.line_count = line_count
+        self.procedures = []  # VbaProcedureのリスト
+        self.select_case_regions = []  # (開始行, 終了行, ネスト数) のリスト
+        self.checkpoints = []  # VbaCheckpointのリスト（行番号順）
+
+    def func_find_procedure(self, line: int):
+        """指定行を含む手続きを返す。手続きの外であればNone。"""
+        import bisect
+
+        position = bisect.bisect_right([p.start_line for p in self.procedures], line)
+        if position and self.procedures[position - 1].end_line >= line:
+            return self.procedures[position - 1]
+        return None
+
+    def func_get_segment(self, start_line: int, end_line: int):
+        """
+        start_line〜end_lineを含む最小の整形範囲を (開始チェックポイント, 終了行) で返す。
+        範囲は手続き単位（または手続きの間の宣言部・空行）に広げられる。
+        """
+        import bisect
+
+        lines = [c.line for c in self.checkpoints]
+        position = max(0, bisect.bisect_right(lines, start_line) - 1)
+        checkpoint = self.checkpoints[position]
+        position = bisect.bisect_right(lines, end_line)
+        if position < len(lines):
+            return checkpoint, lines[position] - 1
+        return checkpoint, self.line_count
+
+    def func_iter_segments(self):
+        """チェックポイントで区切った全ての区間を (チェックポイント, 終了行) で返す。"""
+        for i, checkpoint in enumerate(self.checkpoints):
+            if i + 1 < len(self.checkpoints):
+                yield checkpoint, self.checkpoints[i + 1].line - 1
+            else:
+                yield checkpoint, self.line_count
+
+
 class VbaFormatter:
-    """VBAコードのインデントを整形するロジックを持つクラス。"""
+    """
+    VBAコードのインデントを整形するロジックを持つクラス。
+    モジュール全体の整形に加え、構造インデックスを使って手続き単位の部分整形を行える。
+    """
+
+    PROCEDURE_PATTERN = re.compile(
+        r"^(?:(?:public|private|friend)\s+)?(?:static\s+)?"
+        r"(sub|function|property)\s+(?:(?:get|let|set)\s+)?(\w+)",
+        re.IGNORECASE,
+    )
+    PROCEDURE_END_KEYWORDS = ("end sub", "end function", "end property")
 
     def __init__(self, indent_char: str = INDENT_STRING):
         self.indent_char = indent_char
@@ -295,19 +472,25 @@ class VbaFormatter:
                 clean_line += char
         return clean_line.strip()
 
-    def func_format_code(self, code_string: str) -> str:
-        """与えられたVBAコード文字列を整形して返す。"""
-        lines, formatted_lines, current_indent_level, block_stack = (
-            code_string.splitlines(),
-            [],
-            0,
-            [],
-        )
-        for line in lines:
-            stripped_line = line.strip()
+    def _func_format_lines(
+        self, lines, start, end, checkpoint, formatted_lines, index=None
+    ):
+        """
+        lines[start:end] をcheckpointの状態から整形し、formatted_linesに追加する。
+        indexを指定した場合、手続き・Select Caseの範囲とチェックポイントを記録する。
+        """
+        current_indent_level = checkpoint.indent_level
+        block_stack = list(checkpoint.block_stack)
+        last_blank = checkpoint.last_blank
+        formatted_offset = checkpoint.formatted_line - 1 - len(formatted_lines)
+        open_procedure, select_starts = None, []
+
+        for line_number in range(start + 1, end + 1):
+            stripped_line = lines[line_number - 1].strip()
             if not stripped_line:
-                if formatted_lines and formatted_lines[-1] != "":
+                if not last_blank:
                     formatted_lines.append("")
+                    last_blank = True
                 continue
             judgement_line = self._func_get_judgement_line(
                 stripped_line.replace("_", "")
@@ -335,6 +518,27 @@ class VbaFormatter:
             is_select_case = first_two_words == "select case"
             is_end_select = first_two_words == "end select"
 
+            # 構造インデックスの記録（手続きの開始）
+            if index is not None and is_start_block:
+                match = self.PROCEDURE_PATTERN.match(stripped_line)
+                if match and open_procedure is None:
+                    index.checkpoints.append(
+                        VbaCheckpoint(
+                            line_number,
+                            formatted_offset + len(formatted_lines) + 1,
+                            current_indent_level,
+                            tuple(block_stack),
+                            last_blank,
+                        )
+                    )
+                    open_procedure = (
+                        match.group(2),
+                        match.group(1).lower(),
+                        line_number,
+                        current_indent_level,
+                        len(block_stack),
+                    )
+
             # インデントレベルの調整（デデントを先に処理）
             if is_end_select:
                 current_indent_level = max(0, current_indent_level - 2)
@@ -355,6 +559,7 @@ class VbaFormatter:
             formatted_lines.append(
                 self.indent_char * current_indent_level + stripped_line
             )
+            last_blank = False
 
             # インデントレベルの調整（インデントを後に処理）
             is_single_line_if = False
@@ -376,13 +581,104 @@ class VbaFormatter:
                 if is_start_block and not is_single_line_if:
                     block_stack.append("other")
 
-        # 余分な空行を削除
-        final_lines = []
-        for i, line in enumerate(formatted_lines):
-            if line == "" and (i == 0 or final_lines[-1] == ""):
-                continue
-            final_lines.append(line)
-        return "\n".join(final_lines)
+            # 構造インデックスの記録（Select Caseの範囲と手続きの終了）
+            if index is not None:
+                if is_select_case:
+                    select_starts.append(line_number)
+                elif is_end_select and select_starts:
+                    select_start = select_starts.pop()
+                    index.select_case_regions.append(
+                        (select_start, line_number, len(select_starts))
+                    )
+                if (
+                    open_procedure is not None
+                    and first_two_words in self.PROCEDURE_END_KEYWORDS
+                ):
+                    index.procedures.append(
+                        VbaProcedure(
+                            *open_procedure[:3], line_number, *open_procedure[3:]
+                        )
+                    )
+                    open_procedure = None
+                    if line_number < end:
+                        index.checkpoints.append(
+                            VbaCheckpoint(
+                                line_number + 1,
+                                formatted_offset + len(formatted_lines) + 1,
+                                current_indent_level,
+                                tuple(block_stack),
+                                last_blank,
+                            )
+                        )
+
+        if index is not None and open_procedure is not None:
+            # End Sub等が無いまま終わった手続きは、モジュール末尾までを範囲とする
+            index.procedures.append(
+                VbaProcedure(*open_procedure[:3], end, *open_procedure[3:])
+            )
+        return formatted_lines
+
+    def func_format_with_index(self, code_string: str):
+        """コード全体を整形し、(整形後の行リスト, 構造インデックス) を返す。"""
+        lines = code_string.splitlines()
+        index = VbaStructureIndex(len(lines))
+        initial = VbaCheckpoint(1, 1, 0, (), True)
+        index.checkpoints.append(initial)
+        formatted_lines = self._func_format_lines(
+            lines, 0, len(lines), initial, [], index
+        )
+
+        # 同じ行に重複したチェックポイント（手続きが連続する場合）は先のものを残す
+        unique_checkpoints = []
+        for checkpoint in index.checkpoints:
+            if not unique_checkpoints or unique_checkpoints[-1].line != checkpoint.line:
+                unique_checkpoints.append(checkpoint)
+        index.checkpoints = unique_checkpoints
+        index.select_case_regions.sort()
+        return formatted_lines, index
+
+    def func_build_index(self, code_string: str) -> VbaStructureIndex:
+        """コードの構造インデックスを作成する。"""
+        return self.func_format_with_index(code_string)[1]
+
+    def func_format_range(
+        self, code_string: str, start_line: int, end_line: int, index=None
+    ):
+        """
+        start_line〜end_line（1始まり、元コードの行番号）を含む手続きだけを整形する。
+        整形の開始状態はモジュール先頭から整形し直すのではなく、構造インデックスから取得する。
+        戻り値: (置換開始行, 置換終了行, 整形後の行リスト)
+        置換範囲の元コードを整形後の行リストで置き換えると、モジュール全体を整形した結果と一致する。
+        """
+        lines = code_string.splitlines()
+        if index is None:
+            index = self.func_build_index(code_string)
+        checkpoint, segment_end = index.func_get_segment(start_line, end_line)
+        formatted_lines = self._func_format_lines(
+            lines,
+            checkpoint.line - 1,
+            segment_end,
+            checkpoint._replace(formatted_line=1),
+            [],
+        )
+        if segment_end == len(lines) and formatted_lines and formatted_lines[-1] == "":
+            # 全体の整形結果を行分割した場合と同様に、モジュール末尾の空行は除く
+            formatted_lines.pop()
+        return checkpoint.line, segment_end, formatted_lines
+
+    def func_format_code(self, code_string: str) -> str:
+        """与えられたVBAコード文字列を整形して返す。"""
+        lines = code_string.splitlines()
+        formatted_lines = self._func_format_lines(
+            lines, 0, len(lines), VbaCheckpoint(1, 1, 0, (), True), []
+        )
+        return "\n".join(formatted_lines)
+
+
+def func_is_free_threaded() -> bool:
+    """GILが無効なフリースレッド版CPythonで実行されているかを返す。"""
+    is_gil_enabled = getattr(sys, "_is_gil_enabled", None)
+    return is_gil_enabled is not None and not is_gil_enabled()
 
 
 # ===================================================================================
@@ -396,9 +692,23 @@ def func_format_vba_code(code_string: str) -> str:
     return VBA_FORMATTER_INSTANCE.func_format_code(code_string)
 
 
+def func_load_tray_image():
+    """
+    タスクトレイ用のアイコン画像を読み込む。
+    icoファイルは最大サイズの画像が展開されるため、トレイ表示に必要なサイズへ縮小して保持する。
+    """
+    from PIL import Image
+
+    with Image.open(ICON_FILE_PATH) as source:
+        return source.convert("RGBA").resize(TRAY_ICON_SIZE)
+
+
 def func_create_dummy_image():
     """アイコンファイルが見つからない場合にダミーの画像を生成する。"""
-    width, height, color1, color2 = 64, 64, "black", "white"
+    from PIL import Image, ImageDraw
+
+    width, height = TRAY_ICON_SIZE
+    color1, color2 = "black", "white"
     image = Image.new("RGB", (width, height), color1)
     dc = ImageDraw.Draw(image)
     dc.rectangle((width // 2, 0, width, height // 2), fill=color2)
@@ -418,6 +728,152 @@ def func_find_visible_excel_windows():
     return visible_excel_windows
 
 
+def func_start_thread_profiling() -> list:
+    """
+    これ以降に開始するスレッドごとにcProfileを有効にし、そのプロファイラを格納するリストを返す。
+    計測を終えるときは threading.setprofile(None) を呼び出す。
+    Python 3.12以降は1つのプロファイラが全スレッドを計測するため、スレッドごとの有効化は行われない。
+    """
+    import cProfile
+
+    thread_profilers = []
+
+    def func_enable_thread_profiler(frame, event, arg):
+        sys.setprofile(None)
+        thread_profiler = cProfile.Profile()
+        try:
+            thread_profiler.enable()
+        except ValueError:
+            return  # 別のプロファイラが既に全スレッドを計測している
+        thread_profilers.append(thread_profiler)
+
+    threading.setprofile(func_enable_thread_profiler)
+    return thread_profilers
+
+
+def func_run_with_profile(target, top_n: int = PROFILE_TOP_N):
+    """
+    targetをcProfileで計測しながら実行し、結果をBASE_DIRに保存する。
+    計測中に開始したスレッド（差分計算のワーカースレッド等）も計測し、結果を合算する。
+    ファイル名はタイムスタンプとPIDを含み、同時刻の複数実行でも衝突しない。
+    保存後、内部時間の長い上位top_n件の関数をログに出力する。
+    """
+    import cProfile
+    import pstats
+
+    messages = Messages()
+    profiler = cProfile.Profile()
+    thread_profilers = func_start_thread_profiling()
+    try:
+        return profiler.runcall(target)
+    finally:
+        threading.setprofile(None)
+        timestamp = time.strftime("%Y%m%d_%H%M%S")
+        profile_path = os.path.join(
+            BASE_DIR, f"{PROFILE_FILE_PREFIX}_{timestamp}_{os.getpid()}.prof"
+        )
+        try:
+            stream = io.StringIO()
+            stats = pstats.Stats(profiler, stream=stream)
+            for thread_profiler in thread_profilers:
+                stats.add(thread_profiler)
+            stats.dump_stats(profile_path)
+            logger.info(f"[Profile] {messages.profile_saved(profile_path)}")
+
+            stats.sort_stats(pstats.SortKey.TIME).print_stats(top_n)
+            logger.info(
+                f"[Profile] {messages.profile_top_functions(top_n)}\n{stream.getvalue()}"
+            )
+        except Exception:
+            logger.exception(f"[Profile] {messages.profile_error()}")
+
+
+def func_show_tk_dialog(kind: str, title: str, message: str):
+    """
+    Tkinterのメッセージボックスを表示する。kindは "warning" または "error"。
+    常駐プロセスにTkを保持させないよう、表示のたびにルートを生成・破棄する。
+    """
+    import tkinter as tk
+    from tkinter import messagebox
+
+    root = tk.Tk()
+    root.withdraw()
+    try:
+        # バンドルされたアイコンリソースへのパスを使用
+        icon_path = func_get_resource_path(ICON_FILE_NAME)
+        if os.path.exists(icon_path):
+            root.iconbitmap(icon_path)
+    except Exception:
+        pass  # アイコン設定に失敗しても続行
+    root.wm_attributes("-topmost", 1)
+    if kind == "error":
+        messagebox.showerror(title, message, parent=root)
+    else:
+        messagebox.showwarning(title, message, parent=root)
+    root.destroy()
+
+
+def func_get_process_footprint() -> dict:
+    """
+    現在のプロセスのメモリ使用量・ハンドル数・スレッド数などを返す。
+    Windowsでは、アイコン等のリークを追跡するためにGDI/USERオブジェクト数も取得する。
+    """
+    import psutil
+
+    process = psutil.Process()
+    with process.oneshot():
+        footprint = {
+            "rss_mb": process.memory_info().rss / (1024 * 1024),
+            "handles": (
+                process.num_handles()
+                if hasattr(process, "num_handles")
+                else process.num_fds()
+            ),
+            "threads": process.num_threads(),
+        }
+    footprint["modules"] = len(sys.modules)
+    try:
+        current_process = ctypes.windll.kernel32.GetCurrentProcess()
+        footprint["gdi"] = ctypes.windll.user32.GetGuiResources(current_process, 0)
+        footprint["user"] = ctypes.windll.user32.GetGuiResources(current_process, 1)
+    except AttributeError:
+        pass  # Windows以外
+    return footprint
+
+
+UTF8_SEQUENCE_PATTERN = re.compile(
+    rb"[\xc2-\xdf][\x80-\xbf]|[\xe0-\xef][\x80-\xbf]{2}|[\xf0-\xf4][\x80-\xbf]{3}"
+)
+NON_ASCII_BYTES = bytes(range(0x80, 0x100))
+
+
+def func_read_source_file(
+    path: str, default_encoding: str = SYNC_EXPORT_ENCODING
+) -> str:
+    """
+    vba_exporter・--sync-exportで出力したモジュールのファイルを、文字コードを判定して読み込む。
+    判定はvba_exporterと同じく、試しにデコードせずにBOMとバイトの並びで行う。
+    BOMが無く、ASCII以外のバイトが全て正しいUTF-8の並びであればUTF-8、それ以外は
+    default_encodingとみなす。改行は\nに統一する。
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    if data.startswith(b"\xef\xbb\xbf"):
+        encoding = "utf-8-sig"
+    elif data[:2] in (b"\xff\xfe", b"\xfe\xff"):
+        encoding = "utf-16"
+    else:
+        non_ascii_count = len(data) - len(data.translate(None, NON_ASCII_BYTES))
+        utf8_count = sum(
+            len(sequence) for sequence in UTF8_SEQUENCE_PATTERN.findall(data)
+        )
+        encoding = default_encoding
+        if non_ascii_count and utf8_count == non_ascii_count:
+            encoding = "utf-8"
+    text = data.decode(encoding, "replace")
+    return text.replace("\r\n", "\n").replace("\r", "\n")
+
+
 def func_show_windows_messagebox(title, message, style):
     """
     Tkinterに依存しない、Windows APIを直接呼び出すメッセージボックス。
@@ -428,80 +884,834 @@ def func_show_windows_messagebox(title, message, style):
 
 
 # ===================================================================================
-# 4. フォーマット実行役 (サブプロセス側)
+# 4. オートメーションバックエンド (win32com / シミュレーター)
 # ===================================================================================
-def func_apply_formatting_to_active_excel():
+class Win32ComBackend:
+    """pywin32を介して実際のExcelに接続するオートメーションバックエンド。"""
+
+    name = "win32com"
+
+    def func_initialize(self):
+        pythoncom.CoInitialize()
+
+    def func_uninitialize(self):
+        pythoncom.CoUninitialize()
+
+    def func_get_active_excel(self):
+        return win32com.client.GetActiveObject("Excel.Application")
+
+    def func_dispatch_excel(self):
+        return win32com.client.Dispatch("Excel.Application")
+
+
+class SimulatorStats:
+    """
+    シミュレーターへのCOM呼び出しを記録し、設定された遅延を発生させるクラス。
+    呼び出し1回ごとの固定遅延と、転送する1行ごとの遅延を設定できる。
+    """
+
+    def __init__(self, call_latency_ms: float = 0.0, line_latency_ms: float = 0.0):
+        self.call_latency_ms = call_latency_ms
+        self.line_latency_ms = line_latency_ms
+        self.call_counts = collections.Counter()
+        self._lock = threading.Lock()
+
+    def func_record(self, call_name: str, line_count: int = 0):
+        """COM呼び出し1回分を記録し、遅延を発生させる。"""
+        with self._lock:
+            self.call_counts[call_name] += 1
+        delay_ms = self.call_latency_ms + self.line_latency_ms * line_count
+        if delay_ms > 0:
+            time.sleep(delay_ms / 1000)
+
+    @property
+    def total_calls(self) -> int:
+        with self._lock:
+            return sum(self.call_counts.values())
+
+    def func_reset(self):
+        with self._lock:
+            self.call_counts.clear()
+
+    def func_summary(self) -> str:
+        with self._lock:
+            counts = ", ".join(f"{k}={v}" for k, v in sorted(self.call_counts.items()))
+            return f"total={sum(self.call_counts.values())} ({counts})"
+
+
+class SimulatedCodeModule:
+    """VBIDE.CodeModuleを模したクラス。行番号は1始まり。"""
+
+    def __init__(self, stats: SimulatorStats, code: str = "", parent=None):
+        self._stats = stats
+        self._lines = code.splitlines()
+        self._parent = parent
+
+    @property
+    def Parent(self):
+        self._stats.func_record("Parent")
+        return self._parent
+
+    @property
+    def CountOfLines(self):
+        self._stats.func_record("CountOfLines")
+        return len(self._lines)
+
+    def Lines(self, start_line, count):
+        self._stats.func_record("Lines", count)
+        return "\r\n".join(self._lines[start_line - 1 : start_line - 1 + count])
+
+    def DeleteLines(self, start_line, count=1):
+        self._stats.func_record("DeleteLines", count)
+        del self._lines[start_line - 1 : start_line - 1 + count]
+
+    def InsertLines(self, line, code):
+        # VBEと同様、末尾の改行や空文字列も1行として挿入する
+        new_lines = re.split(r"\r\n|\r|\n", code)
+        self._stats.func_record("InsertLines", len(new_lines))
+        self._lines[line - 1 : line - 1] = new_lines
+
+    def ReplaceLine(self, line, code):
+        self._stats.func_record("ReplaceLine", 1)
+        self._lines[line - 1] = code
+
+
+class SimulatedVBComponent:
+    """VBIDE.VBComponentを模したクラス。"""
+
+    def __init__(
+        self, stats: SimulatorStats, name: str, component_type: int, code: str
+    ):
+        self._stats = stats
+        self._name = name
+        self._type = component_type
+        self._code_module = SimulatedCodeModule(stats, code, self)
+
+    @property
+    def Name(self):
+        self._stats.func_record("Name")
+        return self._name
+
+    @property
+    def Type(self):
+        self._stats.func_record("Type")
+        return self._type
+
+    @property
+    def CodeModule(self):
+        self._stats.func_record("CodeModule")
+        return self._code_module
+
+
+class SimulatedVBComponents:
+    """VBIDE.VBComponentsを模したクラス。Itemはインデックス(1始まり)と名前の両方に対応する。"""
+
+    def __init__(self, stats: SimulatorStats, components):
+        self._stats = stats
+        self._components = list(components)
+
+    def __iter__(self):
+        self._stats.func_record("_NewEnum")
+        return iter(list(self._components))
+
+    @property
+    def Count(self):
+        self._stats.func_record("Count")
+        return len(self._components)
+
+    def Item(self, index):
+        self._stats.func_record("Item")
+        if isinstance(index, int):
+            return self._components[index - 1]
+        for component in self._components:
+            if component._name.lower() == str(index).lower():
+                return component
+        raise KeyError(index)
+
+
+class SimulatedVBProject:
+    """VBIDE.VBProjectを模したクラス。"""
+
+    def __init__(self, stats: SimulatorStats, components):
+        self._stats = stats
+        self._components = SimulatedVBComponents(stats, components)
+
+    @property
+    def VBComponents(self):
+        self._stats.func_record("VBComponents")
+        return self._components
+
+
+class SimulatedWorkbook:
+    """Excel.Workbookを模したクラス。"""
+
+    def __init__(self, stats: SimulatorStats, full_name: str, components):
+        self._stats = stats
+        self._full_name = full_name
+        self._vb_project = SimulatedVBProject(stats, components)
+        self.closed = False
+
+    @property
+    def Name(self):
+        self._stats.func_record("Name")
+        return os.path.basename(self._full_name)
+
+    @property
+    def FullName(self):
+        self._stats.func_record("FullName")
+        return self._full_name
+
+    @property
+    def VBProject(self):
+        self._stats.func_record("VBProject")
+        return self._vb_project
+
+    def Close(self, SaveChanges=False):
+        self._stats.func_record("Close")
+        self.closed = True
+
+
+class SimulatedWorkbooks:
+    """
+    Excel.Workbooksを模したクラス。
+    Openには、事前に登録したブック、エクスポート済みソースのフォルダ、
+    またはコンポーネントを記述したJSONファイルのパスを指定できる。
+    """
+
+    def __init__(self, stats: SimulatorStats, application):
+        self._stats = stats
+        self._application = application
+        self._workbooks = []
+
+    def __iter__(self):
+        self._stats.func_record("_NewEnum")
+        return iter(list(self._workbooks))
+
+    @property
+    def Count(self):
+        self._stats.func_record("Count")
+        return len(self._workbooks)
+
+    def Open(self, path):
+        self._stats.func_record("Open")
+        workbook = self._application.backend.func_load_workbook(path)
+        self._workbooks.append(workbook)
+        self._application.active_workbook = workbook
+        return workbook
+
+
+class SimulatedVBE:
+    """VBIDE.VBEを模したクラス。アクティブなコードペインは持たない。"""
+
+    ActiveCodePane = None
+
+
+class SimulatedApplication:
+    """Excel.Applicationを模したクラス。"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._stats = backend.stats
+        self._workbooks = SimulatedWorkbooks(self._stats, self)
+        self.active_workbook = None
+        self.Visible = False
+        self.VBE = SimulatedVBE()
+
+    @property
+    def Workbooks(self):
+        self._stats.func_record("Workbooks")
+        return self._workbooks
+
+    @property
+    def ActiveWorkbook(self):
+        self._stats.func_record("ActiveWorkbook")
+        return self.active_workbook
+
+    def Quit(self):
+        self._stats.func_record("Quit")
+
+
+class SimulatedExcelBackend:
+    """
+    Windows以外でもCOM経路のベンチマークや回帰テストを行うための、
+    純Pythonで実装したExcel/VBEシミュレーターのバックエンド。
+    """
+
+    name = "simulator"
+    EXTENSION_TYPES = {".bas": 1, ".cls": 2, ".frm": 3}
+
+    def __init__(self, call_latency_ms: float = 0.0, line_latency_ms: float = 0.0):
+        self.stats = SimulatorStats(call_latency_ms, line_latency_ms)
+        self.registered_workbooks = {}
+        self.application = SimulatedApplication(self)
+
+    def func_initialize(self):
+        pass
+
+    def func_uninitialize(self):
+        pass
+
+    def func_get_active_excel(self):
+        return self.application
+
+    def func_dispatch_excel(self):
+        return self.application
+
+    def func_register_workbook(self, full_name: str, components):
+        """components: (コンポーネント名, 種類, コード) のリストでブックを登録する。"""
+        self.registered_workbooks[os.path.abspath(full_name)] = list(components)
+
+    def func_load_workbook(self, path: str) -> SimulatedWorkbook:
+        """登録済みブック、ソースフォルダ、またはJSONファイルからブックを生成する。"""
+        full_name = os.path.abspath(path)
+        if full_name in self.registered_workbooks:
+            specs = self.registered_workbooks[full_name]
+        elif os.path.isdir(full_name):
+            specs = []
+            for file_name in sorted(os.listdir(full_name)):
+                name, ext = os.path.splitext(file_name)
+                if ext.lower() not in self.EXTENSION_TYPES:
+                    continue
+                code = func_read_source_file(os.path.join(full_name, file_name))
+                specs.append((name, self.EXTENSION_TYPES[ext.lower()], code))
+        elif os.path.isfile(full_name):
+            with open(full_name, encoding="utf-8") as f:
+                data = json.load(f)
+            specs = [
+                (c["name"], c.get("type", 1), c["code"]) for c in data["components"]
+            ]
+        else:
+            raise FileNotFoundError(path)
+
+        components = [
+            SimulatedVBComponent(self.stats, name, component_type, code)
+            for name, component_type, code in specs
+        ]
+        return SimulatedWorkbook(self.stats, full_name, components)
+
+    def func_open_as_active(self, path: str) -> SimulatedWorkbook:
+        """ブックを開き、アクティブブックとして設定する。"""
+        return self.application._workbooks.Open(path)
+
+
+AUTOMATION_BACKEND = None
+
+
+def func_get_automation_backend():
+    """
+    現在のオートメーションバックエンドを返す。
+    未設定の場合、環境変数 VBA_AUTOMATION_BACKEND=simulator であればシミュレーターを、
+    それ以外はwin32comを使用する。
+    """
+    global AUTOMATION_BACKEND
+    if AUTOMATION_BACKEND is None:
+        if os.environ.get("VBA_AUTOMATION_BACKEND", "").lower() == "simulator":
+            AUTOMATION_BACKEND = SimulatedExcelBackend(
+                float(os.environ.get("VBA_SIM_CALL_MS", "0")),
+                float(os.environ.get("VBA_SIM_LINE_MS", "0")),
+            )
+            if os.environ.get("VBA_SIM_WORKBOOK"):
+                AUTOMATION_BACKEND.func_open_as_active(os.environ["VBA_SIM_WORKBOOK"])
+        else:
+            AUTOMATION_BACKEND = Win32ComBackend()
+    return AUTOMATION_BACKEND
+
+
+def func_set_automation_backend(backend):
+    """オートメーションバックエンドを差し替える（ベンチマーク・テスト用）。"""
+    global AUTOMATION_BACKEND
+    AUTOMATION_BACKEND = backend
+
+
+# ===================================================================================
+# 5. フォーマット実行役 (サブプロセス側)
+# ===================================================================================
+def func_compute_edit_script(original_code: str):
+    """
+    コードを整形し、元コードとの差分（編集スクリプト）を計算する。
+    差分は構造インデックスの区間（手続き単位）ごとに計算し、変更の無い手続きは比較しない。
+    これにより、巨大なモジュールでも編集された手続きだけが書き戻しの対象になる。
+    ワーカープロセスからも呼び出せるよう、モジュールレベルの関数として定義する。
+    戻り値: 変更が無い場合はNone。変更がある場合は (整形後コード, equal以外のopcodeリスト)。
+    """
+    import difflib
+
+    original_lines = original_code.splitlines()
+    formatted_lines, index = VBA_FORMATTER_INSTANCE.func_format_with_index(
+        original_code
+    )
+    if formatted_lines and formatted_lines[-1] == "":
+        # 整形後コードを文字列にしてから行分割した場合と同様に、末尾の空行は除く
+        formatted_lines.pop()
+    if original_lines == formatted_lines:
+        return None
+
+    hunks = []
+    segments = list(index.func_iter_segments())
+    for position, (checkpoint, segment_end) in enumerate(segments):
+        i1, i2 = checkpoint.line - 1, segment_end
+        j1 = checkpoint.formatted_line - 1
+        if position + 1 < len(segments):
+            j2 = segments[position + 1][0].formatted_line - 1
+        else:
+            j2 = len(formatted_lines)
+        if original_lines[i1:i2] == formatted_lines[j1:j2]:
+            continue
+
+        matcher = difflib.SequenceMatcher(
+            None, original_lines[i1:i2], formatted_lines[j1:j2]
+        )
+        hunks += [
+            (tag, a1 + i1, a2 + i1, b1 + j1, b2 + j1)
+            for tag, a1, a2, b1, b2 in matcher.get_opcodes()
+            if tag != "equal"
+        ]
+    return "\n".join(formatted_lines), hunks
+
+
+class ComCostModel:
+    """
+    CodeModuleへの書き戻しにかかるCOMコストを見積もり、書き戻し方法を選択するクラス。
+    コストは「呼び出し1回の固定コスト + 削除・挿入する1行あたりのコスト」の線形モデルで近似する。
+    係数は実測したCOM呼び出しの遅延に合わせて調整できる。
+    """
+
+    def __init__(
+        self,
+        call_cost_ms: float = COM_CALL_COST_MS,
+        line_cost_ms: float = COM_LINE_COST_MS,
+    ):
+        self.call_cost_ms = call_cost_ms
+        self.line_cost_ms = line_cost_ms
+
+    def func_estimate_cost(self, ranges) -> float:
+        """置換範囲 (i1, i2, j1, j2) のリストを適用する場合の推定コスト(ms)を返す。"""
+        cost = 0.0
+        for i1, i2, j1, j2 in ranges:
+            call_count = (i2 > i1) + (j2 > j1)
+            line_count = (i2 - i1) + (j2 - j1)
+            cost += call_count * self.call_cost_ms + line_count * self.line_cost_ms
+        return cost
+
+    def func_coalesce_ranges(self, ranges):
+        """
+        隣接する置換範囲の間にある一致行を含めて1つにまとめた方が安い場合、範囲を結合する。
+        一致行の再送コストより、削減できるCOM呼び出しのコストが大きい場合にのみ結合する。
+        """
+        merged_ranges = []
+        for current in ranges:
+            if merged_ranges:
+                previous = merged_ranges[-1]
+                candidate = (previous[0], current[1], previous[2], current[3])
+                if self.func_estimate_cost([candidate]) <= self.func_estimate_cost(
+                    [previous, current]
+                ):
+                    merged_ranges[-1] = candidate
+                    continue
+            merged_ranges.append(current)
+        return merged_ranges
+
+    def func_build_plans(self, hunks, original_line_count, formatted_line_count):
+        """
+        編集スクリプトから、書き戻し方法ごとの置換範囲リストを作成する。
+          hunk:     差分ごとに個別に置換する
+          rewrite:  モジュール全体を削除し、整形後のコードを一括で挿入する
+          coalesce: 近接する差分をまとめて範囲ごとに置換する
+        """
+        hunk_ranges = [(i1, i2, j1, j2) for _, i1, i2, j1, j2 in hunks]
+        return {
+            "hunk": hunk_ranges,
+            "rewrite": [(0, original_line_count, 0, formatted_line_count)],
+            "coalesce": self.func_coalesce_ranges(hunk_ranges),
+        }
+
+    def func_choose_plan(self, hunks, original_line_count, formatted_line_count):
+        """推定コストが最小の書き戻し方法を (方法名, 置換範囲リスト, 推定コスト) で返す。"""
+        plans = self.func_build_plans(hunks, original_line_count, formatted_line_count)
+        # コストが同じ場合は辞書順（hunk → rewrite → coalesce）で先のものを優先する
+        strategy = min(plans, key=lambda name: self.func_estimate_cost(plans[name]))
+        return strategy, plans[strategy], self.func_estimate_cost(plans[strategy])
+
+
+def func_apply_ranges(module, formatted_lines, ranges):
+    """置換範囲を後ろから順にCodeModuleへ適用する。"""
+    for i1, i2, j1, j2 in reversed(ranges):
+        start_line = i1 + 1
+        if i2 > i1:
+            module.DeleteLines(start_line, i2 - i1)
+        if j2 > j1:
+            module.InsertLines(start_line, "\n".join(formatted_lines[j1:j2]))
+
+
+def func_get_active_code_pane(excel_app):
+    """
+    VBEのアクティブなコードペインと、表示中のコンポーネント名を返す。
+    CodeModule.CodePaneはペインを新たに開いてしまうため、VBE.ActiveCodePaneのみを参照する。
+    """
+    try:
+        pane = excel_app.VBE.ActiveCodePane
+        if pane is None:
+            return None, None
+        return pane, pane.CodeModule.Parent.Name
+    except Exception:
+        return None, None
+
+
+def func_load_probe_state() -> dict:
+    """前回実行時に記録したモジュールの簡易プローブ情報を読み込む。"""
+    try:
+        with open(PROBE_STATE_FILE_PATH, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def func_write_file_atomic(path: str, data: bytes):
+    """同じフォルダの一時ファイルに書き込んでから置き換え、書き込み途中のファイルを残さない。"""
+    import tempfile
+
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".tmp_")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def func_save_probe_state(state: dict):
+    """プローブ情報を一時ファイル経由で置き換え、書き込み途中の状態を残さない。"""
+    try:
+        func_write_file_atomic(
+            PROBE_STATE_FILE_PATH, json.dumps(state, ensure_ascii=False).encode("utf-8")
+        )
+    except OSError:
+        logger.warning("プローブ情報の保存に失敗しました。", exc_info=True)
+
+
+def func_build_probe_record(lines, line_count: int) -> dict:
+    """
+    整形後（または変更の無い）モジュールの行から、次回の変更検知に使うプローブ情報を作成する。
+    行数・手続き数と、先頭行・末尾行・手続き宣言行の一部についてのCRC32を記録する。
+    line_countはCOMのCountOfLinesの値。末尾の空行はsplitlines()の結果に含まれないため、
+    行数はlinesからではなくline_countで記録し、不足する末尾の行は空行として扱う。
+    """
+    import zlib
+
+    lines = list(lines) + [""] * (line_count - len(lines))
+    headers = [
+        number
+        for number, line in enumerate(lines, start=1)
+        if VbaFormatter.PROCEDURE_PATTERN.match(line.lstrip())
+    ]
+    sampled_headers = headers
+    if len(headers) > PROBE_MAX_HEADER_SAMPLES:
+        step = len(headers) / PROBE_MAX_HEADER_SAMPLES
+        sampled_headers = [
+            headers[int(i * step)] for i in range(PROBE_MAX_HEADER_SAMPLES)
+        ]
+    sample_lines = sorted({1, line_count, *sampled_headers})
+    return {
+        "count": line_count,
+        "procedures": len(headers),
+        "samples": [
+            [number, zlib.crc32(lines[number - 1].encode("utf-8"))]
+            for number in sample_lines
+        ],
+    }
+
+
+def func_is_probe_unchanged(module, line_count: int, record, cost_model) -> bool:
+    """
+    COMから数行だけを読み、前回のプローブ情報と一致するかを判定する。
+    行数が異なる場合や、サンプル行の読み込みが全文の読み込みより高くつく場合はFalseを返す。
+    """
+    import zlib
+
+    if not record or record.get("count") != line_count:
+        return False
+    samples = record.get("samples", [])
+    probe_cost = cost_model.func_estimate_cost([(0, 0, 0, 1)] * len(samples))
+    read_cost = cost_model.func_estimate_cost([(0, 0, 0, line_count)])
+    if probe_cost >= read_cost:
+        return False
+    for number, checksum in samples:
+        if zlib.crc32(module.Lines(number, 1).encode("utf-8")) != checksum:
+            return False
+    return True
+
+
+def func_apply_edit_script(
+    module,
+    formatted_code: str,
+    hunks,
+    original_line_count: int,
+    cost_model: ComCostModel,
+    strategy: str = None,
+):
+    """
+    編集スクリプトをCodeModuleへ適用し、使用した書き戻し方法と推定コストを返す。
+    strategyを省略した場合は、コストモデルで最も安い方法を選択する。
+    """
+    formatted_lines = formatted_code.splitlines()
+    if strategy is None:
+        strategy, ranges, estimated_cost = cost_model.func_choose_plan(
+            hunks, original_line_count, len(formatted_lines)
+        )
+    else:
+        ranges = cost_model.func_build_plans(
+            hunks, original_line_count, len(formatted_lines)
+        )[strategy]
+        estimated_cost = cost_model.func_estimate_cost(ranges)
+
+    func_apply_ranges(module, formatted_lines, ranges)
+    return strategy, estimated_cost
+
+
+def func_get_sync_folder(sync_dir: str, workbook_name: str) -> str:
+    """同期エクスポート先のブックのフォルダ（vba_exporterと同じ <出力先>/<ブック名>）を返す。"""
+    return os.path.join(sync_dir, os.path.splitext(workbook_name)[0])
+
+
+def func_sync_export_modules(
+    sync_folder: str, modules, encoding: str = SYNC_EXPORT_ENCODING
+) -> tuple:
+    """
+    整形済みのモジュールを同期エクスポート先へ書き込む。
+    modulesは(コンポーネント名, ファイル名, コード)の並びで、内容が既存のファイルと同じものは
+    書き込まない。vba_exporterと同じく、VBEが扱う文字コードとCRLF（最終行も改行で終わる）で書き込む。
+    あるモジュールの書き込みに失敗しても（文字コードで表せない文字・ロックされたファイル等）、
+    エラーを記録して残りのモジュールの書き込みを続ける。
+    戻り値: (書き込んだ数, 変更が無かった数, 失敗したコンポーネント名のリスト)
+    """
+    messages = Messages()
+    written, unchanged, failed = 0, 0, []
+    try:
+        os.makedirs(sync_folder, exist_ok=True)
+    except OSError:
+        logger.error(messages.sync_export_error(sync_folder), exc_info=True)
+        return written, unchanged, [component_name for component_name, _, _ in modules]
+
+    for component_name, file_name, code in modules:
+        path = os.path.join(sync_folder, file_name)
+        try:
+            lines = code.splitlines()
+            data = "".join(line + "\r\n" for line in lines).encode(encoding)
+            try:
+                with open(path, "rb") as f:
+                    if f.read() == data:
+                        unchanged += 1
+                        continue
+            except FileNotFoundError:
+                pass
+            func_write_file_atomic(path, data)
+            written += 1
+        except (OSError, UnicodeError):
+            logger.error(messages.sync_export_error(path), exc_info=True)
+            failed.append(component_name)
+    return written, unchanged, failed
+
+
+def func_apply_formatting_to_active_excel(
+    cost_model: ComCostModel = None,
+    probe_verify_every: int = PROBE_FULL_VERIFY_EVERY,
+    sync_dir: str = None,
+    sync_encoding: str = SYNC_EXPORT_ENCODING,
+):
     """
     サブプロセスとして起動され、アクティブなExcelインスタンスに接続し、
     VBAコードのフォーマットを実行する。
+
+    処理は3段のパイプラインで行う。
+      1. COM読み込み: STAスレッド上で全モジュールのコードを一括で読み込む。
+      2. 整形・差分計算: 読み込んだモジュールから順にワーカースレッドへ投入する。
+      3. 書き戻し: 得られた編集スクリプトをSTAスレッド上で直列に適用する。
+    COMの読み込み中に先行モジュールの整形が並行して進むため、
+    処理時間は「COM時間 + 整形時間」ではなく、両者の大きい方に近づく。
+    COMの呼び出し中はGILが解放されるため、GILのある環境でもスレッドで重ねられる。
+    差分計算は3万行でも0.3秒程度のため、起動コストの大きいプロセスプールは使用しない。
+    書き戻し方法は、cost_modelで推定したCOMコストが最小のものを選択する。
+
+    全文の読み込みの前に、前回実行時のプローブ情報（行数とサンプル行）と照合し、
+    一致したモジュールは読み込まずにスキップする。ただしアクティブなコードペインの
+    モジュールは常に全文を読み込み、probe_verify_every回に1回は全モジュールを読み込む。
+    probe_verify_everyに0以下を指定した場合、プローブは使用しない。
+
+    sync_dirを指定した場合、全モジュールの整形後のコードを
+    <sync_dir>/<ブック名>/<コンポーネント名>.<拡張子> へsync_encodingで書き込む。
+    ミラーを常に最新に保つため、この場合はプローブによるスキップを行わない。
+    COMからの再読み込みは行わず、内容が変わらないモジュールは書き込まない。
     """
+    import concurrent.futures
+
     messages = Messages()
+    cost_model = cost_model or ComCostModel()
+    backend = func_get_automation_backend()
+    executor = None
     try:
-        pythoncom.CoInitialize()
-        excel_app = win32com.client.GetActiveObject("Excel.Application")
+        backend.func_initialize()
+        excel_app = backend.func_get_active_excel()
         workbook = excel_app.ActiveWorkbook
         if not workbook or not workbook.Name:
             return
 
         logger.info(f"--- [Formatter] {messages.formatter_starting(workbook.Name)} ---")
         vb_project = workbook.VBProject
+        active_pane, active_component_name = func_get_active_code_pane(excel_app)
+
+        # 前回実行時のプローブ情報。一定回数ごとに全モジュールを読み込んで検証する
+        probe_state = func_load_probe_state()
+        workbook_key = workbook.FullName
+        workbook_probe = probe_state.get(workbook_key, {})
+        run_count = workbook_probe.get("runs", 0) + 1
+        use_probe = probe_verify_every > 0 and run_count % probe_verify_every != 0
+        previous_records = workbook_probe.get("components", {}) if use_probe else {}
+        records, skipped_count = {}, 0
+        sync_folder = sync_dir and func_get_sync_folder(sync_dir, workbook.Name)
+        sync_modules = []
+
+        # ステージ1: COMから一括読み込み（読み込み次第ワーカーへ投入）
+        pending = []
         for component in vb_project.VBComponents:
+            component_name = component.Name
             module = component.CodeModule
-            if module.CountOfLines == 0:
+            line_count = module.CountOfLines
+            if line_count == 0:
                 continue
 
-            original_code = module.Lines(1, module.CountOfLines)
-            formatted_code = func_format_vba_code(original_code)
-
-            if original_code.splitlines() == formatted_code.splitlines():
+            # 同期エクスポート時は、プローブで検知できない編集（行数が変わらず、サンプル行以外を
+            # 変更した場合）でミラーが古くならないよう、全モジュールを読み込む
+            record = previous_records.get(component_name)
+            if (
+                component_name != active_component_name
+                and not sync_folder
+                and func_is_probe_unchanged(module, line_count, record, cost_model)
+            ):
+                records[component_name] = record
+                skipped_count += 1
                 continue
 
-            # 差分を検出し、必要な部分だけを置換
-            matcher = difflib.SequenceMatcher(
-                None, original_code.splitlines(), formatted_code.splitlines()
+            original_code = module.Lines(1, line_count)
+            if sync_folder:
+                extension = SYNC_COMPONENT_EXTENSIONS.get(component.Type)
+                file_name = extension and component_name + extension
+            else:
+                file_name = None
+            if executor is None:
+                # GILのある環境では整形同士は並列に動かないため、1スレッドで十分
+                executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=FORMAT_WORKERS if func_is_free_threaded() else 1
+                )
+            future = executor.submit(func_compute_edit_script, original_code)
+            pending.append(
+                [component_name, module, original_code, line_count, future, file_name]
             )
-            for tag, i1, i2, j1, j2 in reversed(matcher.get_opcodes()):
-                if tag == "equal":
-                    continue
 
-                start_line = i1 + 1
-                if tag == "replace":
-                    module.DeleteLines(start_line, i2 - i1)
-                    module.InsertLines(
-                        start_line, "\n".join(formatted_code.splitlines()[j1:j2])
-                    )
-                elif tag == "delete":
-                    module.DeleteLines(start_line, i2 - i1)
-                elif tag == "insert":
-                    module.InsertLines(
-                        start_line, "\n".join(formatted_code.splitlines()[j1:j2])
-                    )
+        # ステージ2・3: 整形結果を受け取り、COMへ直列に書き戻す
+        for entry in pending:
+            component_name, module, original_code, line_count, future, file_name = entry
+            edit_script = future.result()
+            if edit_script is None:
+                records[component_name] = func_build_probe_record(
+                    original_code.splitlines(), line_count
+                )
+                if file_name:
+                    sync_modules.append((component_name, file_name, original_code))
+                continue
 
-            logger.info(f"  -> {messages.formatter_component(component.Name)}")
+            formatted_code, hunks = edit_script
+            selection = None
+            if active_pane is not None and component_name == active_component_name:
+                try:
+                    selection = active_pane.GetSelection()
+                except Exception:
+                    pass
+            apply_start = time.perf_counter()
+            strategy, estimated_cost = func_apply_edit_script(
+                module, formatted_code, hunks, line_count, cost_model
+            )
+            actual_cost = (time.perf_counter() - apply_start) * 1000
+            if selection and strategy != "hunk":
+                # 一括置換するとカーソルが先頭に戻るため、元の選択範囲を復元する
+                try:
+                    active_pane.SetSelection(*selection)
+                except Exception:
+                    pass
+            # 書き戻し後の行数は、次回のプローブと同じくCOMから取得する
+            records[component_name] = func_build_probe_record(
+                formatted_code.splitlines(), module.CountOfLines
+            )
+            if file_name:
+                sync_modules.append((component_name, file_name, formatted_code))
+            logger.info(
+                f"  -> {messages.formatter_component(component_name)} "
+                f"{messages.apply_strategy(strategy, estimated_cost, actual_cost)}"
+            )
+
+        if sync_folder:
+            written, unchanged, failed = func_sync_export_modules(
+                sync_folder, sync_modules, sync_encoding
+            )
+            summary = messages.sync_export_summary(
+                sync_folder, written, unchanged, len(failed)
+            )
+            logger.info(f"--- [Formatter] {summary} ---")
+            # 同期に失敗したモジュールは、次回プローブでスキップせず全文を読み込み直す
+            for component_name in failed:
+                records.pop(component_name, None)
+
+        if probe_verify_every > 0:
+            probe_state[workbook_key] = {"runs": run_count, "components": records}
+            func_save_probe_state(probe_state)
+        logger.info(
+            f"--- [Formatter] {messages.probe_summary(len(pending), skipped_count)} ---"
+        )
         logger.info(f"--- [Formatter] {messages.formatter_complete_log()} ---")
     except Exception:
         logger.exception(f"---!!! [Formatter] {messages.formatter_error()} !!!---")
     finally:
-        pythoncom.CoUninitialize()
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+        backend.func_uninitialize()
 
 
 # ===================================================================================
-# 5. 監視役アプリケーションクラス
+# 6. 監視役アプリケーションクラス
 # ===================================================================================
 class WatcherApp:
     """タスクトレイ常駐、ファイル監視、サブプロセス起動を管理するメインクラス。"""
 
-    def __init__(self, messages_instance):
+    def __init__(
+        self, messages_instance, formatter_options=None, footprint_interval=None
+    ):
         self.messages = messages_instance
+        # 整形役サブプロセスへ引き継ぐ追加オプション（--profile 等）
+        self.formatter_options = list(formatter_options or [])
+        # フットプリントの記録間隔（秒）。Noneの場合は記録しない
+        self.footprint_interval = footprint_interval
         self.stop_event = threading.Event()
         self.tray_icon = None
-        self.root = tk.Tk()
-        self.root.withdraw()
-        self.root.wm_attributes("-topmost", 1)
         self.watcher_thread = None  # 監視スレッドの参照を保持
 
+    def func_run_footprint_thread(self):
+        """一定間隔でプロセスのフットプリントをログに記録するバックグラウンドスレッド。"""
+        while True:
+            try:
+                footprint = func_get_process_footprint()
+                logger.info(f"[Footprint] {self.messages.footprint(footprint)}")
+            except Exception as e:
+                logger.warning(f"[Footprint] {self.messages.unexpected_error(e)}")
+            if self.stop_event.wait(self.footprint_interval):
+                break
+
     def func_run_watcher_thread(self):
         """アクティブウィンドウとファイル変更を監視するバックグラウンドスレッド。"""
+        import psutil
+
         pythoncom.CoInitialize()
         logger.info(f"[Watcher] {self.messages.monitoring_started()}")
         monitored_file, last_mod_time, excel_closed_time, has_excel_run = (
@@ -592,6 +1802,7 @@ class WatcherApp:
                         else:
                             # スクリプトとして実行されている場合: ["python.exe", "active_vba_formatter.py", "--format-now"]
                             cmd = [sys.executable, __file__, "--format-now"]
+                        cmd += self.formatter_options
 
                         logger.info(f"[Watcher] {self.messages.launching_formatter()}")
                         subprocess.run(
@@ -613,8 +1824,11 @@ class WatcherApp:
 
     def func_setup_and_run_tray(self):
         """タスクトレイアイコンを設定し、監視スレッドを開始する。"""
+        import pystray
+        from pystray import MenuItem as item
+
         try:
-            image = Image.open(ICON_FILE_PATH)
+            image = func_load_tray_image()
         except FileNotFoundError:
             logger.warning(self.messages.icon_not_found())
             image = func_create_dummy_image()
@@ -629,6 +1843,9 @@ class WatcherApp:
         )
         self.watcher_thread.start()
 
+        if self.footprint_interval:
+            threading.Thread(target=self.func_run_footprint_thread, daemon=True).start()
+
         self.tray_icon.run(setup=self.func_show_startup_notification)
 
     def func_show_startup_notification(self, icon):
@@ -648,21 +1865,228 @@ class WatcherApp:
 
         if self.tray_icon:
             self.tray_icon.stop()
-        if self.root:
-            self.root.destroy()
 
 
 # ===================================================================================
-# 6. 起動ロジック
+# 7. ベンチマーク
 # ===================================================================================
+def func_generate_benchmark_code(procedure_count: int = 100) -> str:
+    """インデントが全く無い、ベンチマーク用のVBAコードを生成する。"""
+    lines = []
+    for index in range(procedure_count):
+        lines += [
+            f"Public Sub Procedure{index}()",
+            "Dim i As Long",
+            "For i = 1 To 10",
+            "If i Mod 2 = 0 Then",
+            "Debug.Print i",
+            "Else",
+            'Debug.Print "odd"',
+            "End If",
+            "Next i",
+            "End Sub",
+            "",
+        ]
+    return "\n".join(lines)
+
+
+def func_run_apply_benchmark(
+    call_latency_ms: float, line_latency_ms: float, cost_model: ComCostModel
+):
+    """
+    遅延を設定した模擬CodeModuleに対し、書き戻し方法ごとの所要時間を計測してログに出力する。
+    全行のインデントが崩れたモジュールと、1行だけ崩れたモジュールの2通りで比較する。
+    """
+    misindented_code = func_generate_benchmark_code()
+    formatted_lines = func_format_vba_code(misindented_code).splitlines()
+    one_line_lines = list(formatted_lines)
+    target = next(
+        i
+        for i in range(len(one_line_lines) // 2, len(one_line_lines))
+        if one_line_lines[i].startswith(INDENT_STRING)
+    )
+    one_line_lines[target] = one_line_lines[target].strip()
+    scenarios = {
+        "misindented": misindented_code,
+        "one_line": "\n".join(one_line_lines),
+    }
+
+    logger.info(
+        f"[Benchmark] call={call_latency_ms}ms line={line_latency_ms}ms "
+        f"model(call={cost_model.call_cost_ms}ms line={cost_model.line_cost_ms}ms)"
+    )
+    for scenario, code in scenarios.items():
+        formatted_code, hunks = func_compute_edit_script(code)
+        for strategy in ("hunk", "coalesce", "rewrite", None):
+            stats = SimulatorStats(call_latency_ms, line_latency_ms)
+            module = SimulatedCodeModule(stats, code)
+            start = time.perf_counter()
+            chosen, estimated_cost = func_apply_edit_script(
+                module,
+                formatted_code,
+                hunks,
+                len(code.splitlines()),
+                cost_model,
+                strategy,
+            )
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            if module._lines != formatted_code.splitlines():
+                raise AssertionError(f"{scenario}/{chosen}: 書き戻し結果が一致しません")
+            label = chosen if strategy else f"auto({chosen})"
+            logger.info(
+                f"[Benchmark] {scenario:<12} {label:<16} calls={stats.total_calls:<5} "
+                f"estimated={estimated_cost:9.1f}ms actual={elapsed_ms:9.1f}ms"
+            )
+
+
+# ===================================================================================
+# 8. 起動ロジック
+# ===================================================================================
+def func_parse_arguments(argv):
+    """
+    実行時引数を解析する。
+    exe化された環境では未知の引数が渡されることもあるため、未知の引数は無視する。
+    """
+    parser = argparse.ArgumentParser(prog=os.path.basename(sys.argv[0]))
+    parser.add_argument(
+        "--format-now",
+        action="store_true",
+        help="アクティブなブックを一度だけ整形して終了する（整形役）",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="整形処理をcProfileで計測し、結果をログと同じフォルダに保存する",
+    )
+    parser.add_argument(
+        "--profile-top",
+        type=int,
+        default=PROFILE_TOP_N,
+        help="ログに出力する上位関数の件数",
+    )
+    parser.add_argument(
+        "--measure-footprint",
+        action="store_true",
+        help="常駐プロセスのメモリ使用量・ハンドル数を定期的にログへ記録する",
+    )
+    parser.add_argument(
+        "--footprint-interval",
+        type=float,
+        default=FOOTPRINT_INTERVAL_SECONDS,
+        help="--measure-footprint の記録間隔(秒)",
+    )
+    parser.add_argument(
+        "--com-call-ms",
+        type=float,
+        default=None,
+        help="書き戻しコストモデル: COM呼び出し1回あたりのコスト(ms)",
+    )
+    parser.add_argument(
+        "--com-line-ms",
+        type=float,
+        default=None,
+        help="書き戻しコストモデル: 削除・挿入する1行あたりのコスト(ms)",
+    )
+    parser.add_argument(
+        "--probe-verify-every",
+        type=int,
+        default=PROBE_FULL_VERIFY_EVERY,
+        help="変更検知プローブを使わずに全モジュールを読み込む間隔（回）。0でプローブ無効",
+    )
+    parser.add_argument(
+        "--sync-export",
+        nargs="?",
+        const=SYNC_EXPORT_DIR,
+        default=None,
+        metavar="DIR",
+        help="保存を検知するたびに、変更のあったモジュールをDIR（既定はvba_source）へエクスポートする",
+    )
+    parser.add_argument(
+        "--sync-encoding",
+        default=SYNC_EXPORT_ENCODING,
+        help=f"--sync-export で書き込むファイルの文字コード（既定は {SYNC_EXPORT_ENCODING}）",
+    )
+    parser.add_argument(
+        "--benchmark-apply",
+        action="store_true",
+        help="模擬CodeModuleで書き戻し方法ごとの所要時間を計測して終了する",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=("win32com", "simulator"),
+        default=None,
+        help="オートメーションバックエンド（simulatorはpywin32無しで動作する）",
+    )
+    parser.add_argument(
+        "--sim-workbook",
+        default=None,
+        help="シミュレーター: アクティブブックとして開くソースフォルダまたはJSONファイル",
+    )
+    parser.add_argument(
+        "--sim-call-ms",
+        type=float,
+        default=1.0,
+        help="シミュレーター: COM呼び出し1回あたりの遅延(ms)",
+    )
+    parser.add_argument(
+        "--sim-line-ms",
+        type=float,
+        default=0.01,
+        help="シミュレーター: 転送する1行あたりの遅延(ms)",
+    )
+    args, _ = parser.parse_known_args(argv)
+    # 保存のたびに書き込みで失敗しないよう、起動時に文字コード名を検証する
+    try:
+        codecs.lookup(args.sync_encoding)
+    except LookupError:
+        parser.error(f"unknown encoding: {args.sync_encoding}")
+    return args
+
+
 if __name__ == "__main__":
     # 実行時引数で「監視役」か「整形役」かを判断
-    is_formatter_process = len(sys.argv) > 1 and sys.argv[1] == "--format-now"
-
-    if is_formatter_process:
+    args = func_parse_arguments(sys.argv[1:])
+    cost_model = ComCostModel()
+    if args.com_call_ms is not None:
+        cost_model.call_cost_ms = args.com_call_ms
+    if args.com_line_ms is not None:
+        cost_model.line_cost_ms = args.com_line_ms
+
+    if args.backend == "simulator":
+        simulator = SimulatedExcelBackend(args.sim_call_ms, args.sim_line_ms)
+        if args.sim_workbook:
+            simulator.func_open_as_active(args.sim_workbook)
+        func_set_automation_backend(simulator)
+    elif args.backend == "win32com":
+        func_set_automation_backend(Win32ComBackend())
+
+    if args.benchmark_apply:
+        func_setup_logging(log_to_file=False)
+        func_run_apply_benchmark(args.sim_call_ms, args.sim_line_ms, cost_model)
+    elif args.format_now:
         # 整形役（サブプロセス）の場合、ログはコンソールにのみ出力
         func_setup_logging(log_to_file=False)
-        func_apply_formatting_to_active_excel()
+        if args.profile:
+            func_run_with_profile(
+                lambda: func_apply_formatting_to_active_excel(
+                    cost_model,
+                    args.probe_verify_every,
+                    args.sync_export,
+                    args.sync_encoding,
+                ),
+                top_n=args.profile_top,
+            )
+        else:
+            func_apply_formatting_to_active_excel(
+                cost_model,
+                args.probe_verify_every,
+                args.sync_export,
+                args.sync_encoding,
+            )
+
+        backend = func_get_automation_backend()
+        if isinstance(backend, SimulatedExcelBackend):
+            logger.info(f"[Simulator] COM calls: {backend.stats.func_summary()}")
     else:
         # 監視役（メインプロセス）の場合、ログをファイルにも出力
         func_setup_logging(log_to_file=True)
@@ -679,44 +2103,40 @@ if __name__ == "__main__":
                 logger.warning(
                     "ミューテックスが既に存在するため、二重起動と判断しました。"
                 )
-                # Tkinterをこの場で初期化し、アイコンを設定してメッセージボックスを表示
-                root = tk.Tk()
-                root.withdraw()
-                try:
-                    # バンドルされたアイコンリソースへのパスを使用
-                    icon_path = func_get_resource_path(ICON_FILE_NAME)
-                    if os.path.exists(icon_path):
-                        root.iconbitmap(icon_path)
-                except Exception:
-                    pass  # アイコン設定に失敗しても続行
-                root.wm_attributes("-topmost", 1)
-                messagebox.showwarning(
-                    messages.app_name(), messages.app_is_running(), parent=root
+                # Tkinterはこの場でのみ初期化し、メッセージボックスを表示
+                func_show_tk_dialog(
+                    "warning", messages.app_name(), messages.app_is_running()
                 )
-                root.destroy()
                 sys.exit(0)
             else:
                 logger.exception(
                     "ミューテックスの作成中に予期せぬエラーが発生しました。"
                 )
-                root = tk.Tk()
-                root.withdraw()
-                try:
-                    icon_path = func_get_resource_path(ICON_FILE_NAME)
-                    if os.path.exists(icon_path):
-                        root.iconbitmap(icon_path)
-                except Exception:
-                    pass
-                root.wm_attributes("-topmost", 1)
-                error_msg = messages.startup_check_error(e)
-                messagebox.showerror(
-                    messages.startup_error_title(), error_msg, parent=root
+                func_show_tk_dialog(
+                    "error",
+                    messages.startup_error_title(),
+                    messages.startup_check_error(e),
                 )
-                root.destroy()
                 sys.exit(1)
 
         logger.info("ミューテックスの作成に成功。監視アプリケーションを起動します。")
-        app = WatcherApp(messages)
+        # --profile 付きで起動された場合、保存ごとの整形処理をすべて計測する
+        formatter_options = []
+        if args.profile:
+            formatter_options += ["--profile", "--profile-top", str(args.profile_top)]
+        if args.com_call_ms is not None:
+            formatter_options += ["--com-call-ms", str(args.com_call_ms)]
+        if args.com_line_ms is not None:
+            formatter_options += ["--com-line-ms", str(args.com_line_ms)]
+        if args.probe_verify_every != PROBE_FULL_VERIFY_EVERY:
+            formatter_options += ["--probe-verify-every", str(args.probe_verify_every)]
+        if args.sync_export:
+            formatter_options += ["--sync-export", os.path.abspath(args.sync_export)]
+            formatter_options += ["--sync-encoding", args.sync_encoding]
+        footprint_interval = None
+        if args.measure_footprint:
+            footprint_interval = args.footprint_interval
+        app = WatcherApp(messages, formatter_options, footprint_interval)
         app.func_setup_and_run_tray()
 
         if mutex:
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# 各ツールは単体のスクリプトとして配布しているため、フォルダをインポートパスに追加する
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for tool_dir in ("active_vba_formatter", "vba_exporter"):
+    sys.path.insert(0, os.path.join(REPO_ROOT, tool_dir))
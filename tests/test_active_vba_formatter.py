@@ -0,0 +1,317 @@
+import logging
+import random
+
+import pytest
+
+import active_vba_formatter as formatter_module
+from active_vba_formatter import VbaFormatter, VbaProcedure
+
+SAMPLE_MODULE = """Option Explicit
+Private counter As Long
+
+' Returns the label for a value
+Public Function Label(ByVal value As Long) As String
+Select Case value
+Case 1
+Label = "one"
+Case Else
+Select Case value Mod 2
+Case 0
+Label = "even"
+Case Else
+Label = "odd"
+End Select
+End Select
+End Function
+
+Private Sub Count()
+If counter > 0 Then counter = counter + 1
+For i = 1 To 3
+counter = counter + i
+Next
+End Sub
+
+Property Get Total() As Long
+Total = counter
+End Property
+"""
+
+
+def test_build_index_records_procedure_boundaries():
+    """手続きの範囲と種類、開始時点のインデント状態を記録する"""
+    index = VbaFormatter().func_build_index(SAMPLE_MODULE)
+
+    assert index.procedures == [
+        VbaProcedure("Label", "function", 5, 17, 0, 0),
+        VbaProcedure("Count", "sub", 19, 24, 0, 0),
+        VbaProcedure("Total", "property", 26, 28, 0, 0),
+    ]
+    assert index.func_find_procedure(3) is None
+    assert index.func_find_procedure(5).name == "Label"
+    assert index.func_find_procedure(17).name == "Label"
+    assert index.func_find_procedure(18) is None
+    assert index.func_find_procedure(22).name == "Count"
+    assert index.func_find_procedure(28).name == "Total"
+
+
+def test_build_index_records_nested_select_case_regions():
+    """Select Caseの範囲を (開始行, 終了行, ネスト数) で記録する"""
+    index = VbaFormatter().func_build_index(SAMPLE_MODULE)
+
+    assert index.select_case_regions == [(6, 16, 0), (10, 15, 1)]
+
+
+def test_build_index_closes_unterminated_procedure_at_module_end():
+    """End Sub の無い手続きは、モジュール末尾までを範囲とする"""
+    index = VbaFormatter().func_build_index("Sub A()\nx = 1\n\nSub B()\ny = 2\n")
+
+    assert [(p.name, p.start_line, p.end_line) for p in index.procedures] == [
+        ("A", 1, 5)
+    ]
+
+
+def test_format_range_expands_to_the_enclosing_procedure():
+    """指定行を含む手続きだけを整形し、その置換範囲を返す"""
+    start, end, lines = VbaFormatter().func_format_range(SAMPLE_MODULE, 21, 21)
+
+    assert (start, end) == (19, 24)
+    assert lines == [
+        "Private Sub Count()",
+        "    If counter > 0 Then counter = counter + 1",
+        "    For i = 1 To 3",
+        "        counter = counter + i",
+        "    Next",
+        "End Sub",
+    ]
+
+
+# --- 部分整形の置換結果が全体の整形と一致することの検証 ---
+STATEMENTS = [
+    "x = x + 1",
+    'Debug.Print "If x Then"',
+    "' comment with End If",
+    "If x > 0 Then y = 1",
+    "Call Run(x, _",
+    "    y)",
+]
+BLOCKS = [
+    ("If x > 0 Then", ["Else", "ElseIf x < 0 Then"], "End If"),
+    ("For i = 1 To 10", [], "Next"),
+    ("Do While x < 10", [], "Loop"),
+    ("With Sheet1", [], "End With"),
+]
+
+
+def _generate_body(rng, depth):
+    lines = []
+    for _ in range(rng.randint(1, 4)):
+        choice = rng.random()
+        if depth < 3 and choice < 0.25:
+            lines.append("Select Case x")
+            for case in ("Case 1", "Case 2, 3", "Case Else")[: rng.randint(1, 3)]:
+                lines.append(case)
+                lines += _generate_body(rng, depth + 1)
+            lines.append("End Select")
+        elif depth < 3 and choice < 0.6:
+            start, middles, end = rng.choice(BLOCKS)
+            lines.append(start)
+            lines += _generate_body(rng, depth + 1)
+            if middles and rng.random() < 0.5:
+                lines.append(rng.choice(middles))
+                lines += _generate_body(rng, depth + 1)
+            lines.append(end)
+        elif choice < 0.7:
+            lines += [""] * rng.randint(1, 2)
+        else:
+            lines.append(rng.choice(STATEMENTS))
+    return lines
+
+
+def _generate_module(rng):
+    lines = rng.choice([[], [""], ["Option Explicit", "Private x As Long", ""]])
+    for number in range(rng.randint(1, 5)):
+        if rng.random() < 0.3:
+            lines.append("' procedure comment")
+        kind, end = rng.choice(
+            [
+                ("Sub", "End Sub"),
+                ("Function", "End Function"),
+                ("Property Get", "End Property"),
+            ]
+        )
+        scope = rng.choice(["", "Public ", "Private "])
+        lines.append(f"{scope}{kind} Proc{number}()")
+        lines += _generate_body(rng, 0)
+        lines.append(end)
+        lines += [""] * rng.randint(0, 2)
+    return lines
+
+
+def _misindent(rng, lines):
+    """行のインデントを崩し、一部の行の後ろに空行を挿入する"""
+    result = []
+    for line in lines:
+        if rng.random() < 0.5:
+            line = " " * rng.choice([0, 1, 4, 8, 12]) + line.strip()
+        result.append(line)
+        if rng.random() < 0.1:
+            result += [""] * rng.randint(1, 2)
+    return result
+
+
+@pytest.mark.parametrize("seed", range(300))
+def test_format_range_splice_matches_full_formatting(seed):
+    """
+    整形済みのモジュールの一部の手続きを崩し、崩した範囲をfunc_format_rangeで置き換えると、
+    モジュール全体を整形した結果と一致する
+    """
+    rng = random.Random(seed)
+    formatter = VbaFormatter()
+    formatted = formatter.func_format_code(
+        "\n".join(_generate_module(rng))
+    ).splitlines()
+    index = formatter.func_build_index("\n".join(formatted))
+    procedure = rng.choice(index.procedures)
+
+    lines = list(formatted)
+    first = rng.randint(procedure.start_line, procedure.end_line)
+    last = rng.randint(first, procedure.end_line)
+    misindented = _misindent(rng, lines[first - 1 : last])
+    lines[first - 1 : last] = misindented
+    code = "\n".join(lines)
+    # 末尾に挿入した空行は、splitlines()でモジュールの行から除かれる
+    lines = code.splitlines()
+    last = min(first + len(misindented) - 1, len(lines))
+
+    start, end, replacement = formatter.func_format_range(code, first, last)
+    spliced = lines[: start - 1] + replacement + lines[end:]
+
+    assert start <= first and last <= end
+    assert spliced == formatter.func_format_code(code).splitlines()
+
+
+def test_format_range_with_prebuilt_index_matches_full_formatting():
+    """構造インデックスを渡した場合も、同じ置換範囲と結果を返す"""
+    formatter = VbaFormatter()
+    code = formatter_module.func_format_vba_code(SAMPLE_MODULE)
+    lines = code.splitlines()
+    lines[11] = lines[11].strip()
+    code = "\n".join(lines)
+    index = formatter.func_build_index(code)
+
+    start, end, replacement = formatter.func_format_range(code, 12, 12, index)
+
+    assert (start, end, replacement) == formatter.func_format_range(code, 12, 12)
+    spliced = lines[: start - 1] + replacement + lines[end:]
+    assert spliced == formatter.func_format_code(code).splitlines()
+
+
+# --- シミュレーターを使った整形・書き戻し（整形役）の検証 ---
+def _generate_procedures(count=6, statements=20):
+    lines = []
+    for number in range(count):
+        lines.append(f"Sub Proc{number}()")
+        lines += [f"    x = {i}" for i in range(statements)]
+        lines += ["End Sub", ""]
+    return lines
+
+
+@pytest.fixture
+def simulator(tmp_path, monkeypatch):
+    """
+    シミュレーターをオートメーションバックエンドにし、プローブ情報を一時フォルダに保存する。
+    ログのメッセージを照合するため、OSの言語によらず英語のメッセージとする。
+    """
+    backend = formatter_module.SimulatedExcelBackend()
+    monkeypatch.setattr(formatter_module, "func_is_japanese_os", lambda: False)
+    monkeypatch.setattr(formatter_module, "AUTOMATION_BACKEND", backend)
+    monkeypatch.setattr(
+        formatter_module, "PROBE_STATE_FILE_PATH", str(tmp_path / "probe.json")
+    )
+    return backend
+
+
+def _open_workbook(backend, tmp_path, components):
+    path = str(tmp_path / "Book1.xlsm")
+    backend.func_register_workbook(path, components)
+    return backend.func_open_as_active(path)
+
+
+def _module_lines(workbook, component_name):
+    return workbook.VBProject.VBComponents.Item(component_name).CodeModule._lines
+
+
+@pytest.mark.parametrize(
+    "strategy, misindented_lines, cost_model",
+    [
+        # 1行だけ崩れている場合、差分ごとの置換が最も転送行数が少ない
+        ("hunk", [3], formatter_module.ComCostModel(0.0, 1.0)),
+        # 離れた差分が多く、呼び出し回数のみが高い場合は全体を一括で置換する
+        ("rewrite", [3, 30, 60, 90, 120], formatter_module.ComCostModel(1.0, 0.0)),
+        # 近接した差分は、間の一致行を含めて1回で置換する
+        ("coalesce", [3, 5], formatter_module.ComCostModel(1.0, 0.01)),
+    ],
+)
+def test_apply_formatting_writes_back_with_each_strategy(
+    simulator, tmp_path, caplog, strategy, misindented_lines, cost_model
+):
+    """コストモデルで選択した書き戻し方法で、モジュールが全体を整形した結果と一致する"""
+    lines = _generate_procedures()
+    for line_index in misindented_lines:
+        lines[line_index] = lines[line_index].strip()
+    code = "\n".join(lines)
+    workbook = _open_workbook(simulator, tmp_path, [("Module1", 1, code)])
+    caplog.set_level(logging.INFO, logger=formatter_module.logger.name)
+
+    formatter_module.func_apply_formatting_to_active_excel(cost_model)
+
+    assert _module_lines(workbook, "Module1") == (
+        formatter_module.func_format_vba_code(code).splitlines()
+    )
+    assert f"strategy: {strategy}," in caplog.text
+
+
+def test_apply_formatting_leaves_formatted_modules_untouched(simulator, tmp_path):
+    """整形済みのモジュールには書き込まない"""
+    code = "\n".join(_generate_procedures())
+    _open_workbook(simulator, tmp_path, [("Module1", 1, code)])
+
+    formatter_module.func_apply_formatting_to_active_excel()
+
+    assert simulator.stats.call_counts["DeleteLines"] == 0
+    assert simulator.stats.call_counts["InsertLines"] == 0
+
+
+def test_apply_formatting_skips_unchanged_modules_by_probe(simulator, tmp_path, caplog):
+    """2回目の実行では、変更の無いモジュールを全文読み込みせずにスキップする"""
+    code = "\n".join(_generate_procedures(statements=200))
+    _open_workbook(simulator, tmp_path, [("Module1", 1, code)])
+    formatter_module.func_apply_formatting_to_active_excel()
+    simulator.stats.func_reset()
+    caplog.set_level(logging.INFO, logger=formatter_module.logger.name)
+
+    formatter_module.func_apply_formatting_to_active_excel()
+
+    # プローブのサンプル行（手続き宣言と末尾）を1行ずつ読み込むのみ
+    assert "Modules read in full: 0 / skipped as unchanged: 1" in caplog.text
+    assert simulator.stats.call_counts["Lines"] == 7
+
+
+def test_sync_export_mirrors_edits_missed_by_probe(simulator, tmp_path):
+    """同期エクスポート時は、行数が変わらずサンプル行以外の編集もファイルに反映する"""
+    lines = _generate_procedures(statements=200)
+    workbook = _open_workbook(simulator, tmp_path, [("Module1", 1, "\n".join(lines))])
+    sync_dir = str(tmp_path / "vba_source")
+    formatter_module.func_apply_formatting_to_active_excel(
+        sync_dir=sync_dir, sync_encoding="cp1252"
+    )
+    _module_lines(workbook, "Module1")[5] = "    x = -1"
+
+    formatter_module.func_apply_formatting_to_active_excel(
+        sync_dir=sync_dir, sync_encoding="cp1252"
+    )
+
+    with open(tmp_path / "vba_source" / "Book1" / "Module1.bas", "rb") as f:
+        data = f.read()
+    assert b"    x = -1\r\n" in data
+    assert data.endswith(b"End Sub\r\n")
@@ -0,0 +1,238 @@
+import json
+import os
+
+import pytest
+
+import vba_exporter
+from vba_exporter import EXIT_OK, EXIT_USAGE_ERROR, VbaExportEngine
+
+MODULE_A = 'Attribute VB_Name = "ModA"\nSub A()\nx = 1\nEnd Sub'
+MODULE_B = 'Attribute VB_Name = "ModB"\nFunction B()\nB = 2\nEnd Function'
+SHARED = 'Attribute VB_Name = "Shared"\nSub Log(message)\nDebug.Print message\nEnd Sub'
+
+
+class CountingSimulator(vba_exporter.SimulatedExcelBackend):
+    """起動したExcel（dispatch_new_excel）の数を数えるシミュレーター"""
+
+    def __init__(self):
+        super().__init__()
+        self.new_excel_count = 0
+
+    def dispatch_new_excel(self):
+        self.new_excel_count += 1
+        return super().dispatch_new_excel()
+
+
+@pytest.fixture
+def simulator(monkeypatch):
+    backend = CountingSimulator()
+    monkeypatch.setattr(vba_exporter, "_automation_backend", backend)
+    return backend
+
+
+def write_workbook(path, components):
+    """シミュレーターで開けるブック（コンポーネントを記述したJSONファイル）を作成する"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    data = {"components": [{"name": name, "code": code} for name, code in components]}
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    return str(path)
+
+
+def run_headless(tmp_path, *argv):
+    """ヘッドレスCLIを実行し、(終了コード, 進捗イベントのリスト) を返す"""
+    progress_path = tmp_path / "progress.ndjson"
+    args = vba_exporter.parse_arguments(
+        ["--headless", "--progress-file", str(progress_path), *argv]
+    )
+    exit_code = vba_exporter.run_headless(args)
+    with open(progress_path, encoding="utf-8") as f:
+        return exit_code, [json.loads(line) for line in f]
+
+
+def test_export_writes_formatted_modules_with_crlf(simulator, tmp_path):
+    """整形したモジュールを、指定の文字コードとCRLFで書き込む"""
+    book = write_workbook(tmp_path / "Book1.xlsm", [("ModA", MODULE_A + "\n' café")])
+    output_dir = str(tmp_path / "vba_source")
+
+    failed = VbaExportEngine(output_dir, encoding="cp1252").export_workbooks([book])
+
+    assert failed == 0
+    with open(os.path.join(output_dir, "Book1", "ModA.bas"), "rb") as f:
+        assert f.read() == (
+            b'Attribute VB_Name = "ModA"\r\nSub A()\r\n    x = 1\r\nEnd Sub\r\n'
+            b"' caf\xe9\r\n"
+        )
+
+
+def test_store_export_deduplicates_shared_modules(simulator, tmp_path):
+    """重複排除ストアには同一モジュールを1度だけ保存し、ブックごとに対応表を書き込む"""
+    books = [
+        write_workbook(
+            tmp_path / "Book1.xlsm", [("ModA", MODULE_A), ("Shared", SHARED)]
+        ),
+        write_workbook(
+            tmp_path / "Book2.xlsm", [("ModB", MODULE_B), ("Shared", SHARED)]
+        ),
+    ]
+    output_dir = str(tmp_path / "vba_source")
+    events = []
+
+    engine = VbaExportEngine(output_dir, progress=events.append, use_store=True)
+    assert engine.export_workbooks(books) == 0
+
+    done = events[-1]
+    assert (done["new_objects"], done["reused_objects"]) == (3, 1)
+    with open(os.path.join(output_dir, "Book1", "index.json"), encoding="utf-8") as f:
+        index = json.load(f)
+    assert sorted(index["components"]) == ["ModA.bas", "Shared.bas"]
+    assert not os.path.exists(os.path.join(output_dir, "Book1", "ModA.bas"))
+
+    # 対応表からストアのオブジェクトを参照して読み込める
+    modules = vba_exporter.read_export_folder(os.path.join(output_dir, "Book2"))
+    assert (
+        modules["Shared.bas"] == vba_exporter.VbaFormatter().format_code(SHARED) + "\n"
+    )
+
+    # 再エクスポートでは既存のオブジェクトを書き込まない
+    events.clear()
+    engine = VbaExportEngine(output_dir, progress=events.append, use_store=True)
+    assert engine.export_workbooks(books) == 0
+    assert (events[-1]["new_objects"], events[-1]["reused_objects"]) == (0, 4)
+
+
+def test_reexport_removes_only_files_written_for_the_same_workbook(simulator, tmp_path):
+    """同じブックから前回出力したファイルのみを削除し、他のブックの出力は残す"""
+    output_dir = str(tmp_path / "vba_source")
+    book_a = write_workbook(tmp_path / "a" / "Book1.xlsm", [("ModA", MODULE_A)])
+    book_b = write_workbook(
+        tmp_path / "b" / "Book1.xlsm", [("ModB", MODULE_B), ("Shared", SHARED)]
+    )
+    folder = os.path.join(output_dir, "Book1")
+    events = []
+    engine = VbaExportEngine(output_dir, progress=events.append)
+
+    engine.export_workbooks([book_a])
+    engine.export_workbooks([book_b])
+    assert sorted(os.listdir(folder)) == [
+        vba_exporter.EXPORT_MANIFEST_FILE_NAME,
+        "ModA.bas",
+        "ModB.bas",
+        "Shared.bas",
+    ]
+    assert [e["owner"] for e in events if e["event"] == "cleanup_skipped"] == [book_a]
+
+    # コンポーネントを削除したブックを再エクスポートすると、そのファイルのみ削除される
+    write_workbook(book_b, [("ModB", MODULE_B)])
+    engine.export_workbooks([book_b])
+    assert sorted(os.listdir(folder)) == [
+        vba_exporter.EXPORT_MANIFEST_FILE_NAME,
+        "ModA.bas",
+        "ModB.bas",
+    ]
+
+
+def test_compare_reports_changed_procedures(simulator, tmp_path):
+    """ブックとエクスポート済みフォルダを手続き単位で比較する"""
+    book = write_workbook(
+        tmp_path / "Book1.xlsm", [("ModA", MODULE_A), ("ModB", MODULE_B)]
+    )
+    output_dir = str(tmp_path / "vba_source")
+    VbaExportEngine(output_dir).export_workbooks([book])
+    folder = os.path.join(output_dir, "Book1")
+    changed_module = MODULE_A + "\n\nSub C()\nEnd Sub"
+    write_workbook(book, [("ModA", changed_module), ("ModB", "    " + MODULE_B)])
+    simulator.stats.reset()
+    events = []
+
+    changed = VbaExportEngine(output_dir, progress=events.append).compare(folder, book)
+
+    assert changed == 1
+    procedure_diffs = [
+        (e["component"], e["procedure"], e["status"])
+        for e in events
+        if e["event"] == "procedure_diff"
+    ]
+    assert procedure_diffs == [("ModA.bas", "Sub C", "added")]
+    assert events[-1]["identical_modules"] == 1
+    # ブックは専用のExcelで読み込み、読み込み後に終了する
+    assert simulator.new_excel_count == 1
+    assert simulator.stats.call_counts["Quit"] == 1
+
+
+def test_headless_jobs_reuse_one_excel_per_worker(simulator, tmp_path):
+    """--jobs では、ワーカーごとに起動したExcelを後続のブックで使い回す"""
+    for number in range(6):
+        write_workbook(tmp_path / "books" / f"Book{number}.xlsm", [("ModA", MODULE_A)])
+
+    exit_code, events = run_headless(
+        tmp_path,
+        str(tmp_path / "books" / "*.xlsm"),
+        "--jobs",
+        "2",
+        "--output",
+        str(tmp_path / "vba_source"),
+    )
+
+    assert exit_code == EXIT_OK
+    assert events[-1]["succeeded"] == 6
+    assert 1 <= simulator.new_excel_count <= 2
+    assert simulator.stats.call_counts["Quit"] == simulator.new_excel_count
+    for number in range(6):
+        assert os.path.isfile(tmp_path / "vba_source" / f"Book{number}" / "ModA.bas")
+
+
+def test_headless_jobs_restart_excel_after_failed_workbook(simulator, tmp_path):
+    """失敗したブックの後は、そのワーカーのExcelを終了して起動し直す"""
+    for number in range(5):
+        write_workbook(tmp_path / "books" / f"Book{number}.xlsm", [("ModA", MODULE_A)])
+    with open(tmp_path / "books" / "Broken.xlsm", "w", encoding="utf-8") as f:
+        f.write("not a workbook")
+
+    exit_code, events = run_headless(
+        tmp_path,
+        str(tmp_path / "books" / "*.xlsm"),
+        "--jobs",
+        "2",
+        "--output",
+        str(tmp_path / "vba_source"),
+    )
+
+    assert exit_code == vba_exporter.EXIT_EXPORT_FAILED
+    assert (events[-1]["succeeded"], events[-1]["failed"]) == (5, 1)
+    assert simulator.new_excel_count <= 3
+    assert simulator.stats.call_counts["Quit"] == simulator.new_excel_count
+
+
+def test_headless_rejects_workbooks_sharing_an_output_folder(simulator, tmp_path):
+    """別のフォルダにある同名のブックは、何もエクスポートせずに使用法エラーとする"""
+    write_workbook(tmp_path / "a" / "Book1.xlsm", [("ModA", MODULE_A)])
+    write_workbook(tmp_path / "b" / "Book1.xlsm", [("ModB", MODULE_B)])
+
+    exit_code, events = run_headless(
+        tmp_path,
+        str(tmp_path / "**" / "*.xlsm"),
+        "--jobs",
+        "2",
+        "--output",
+        str(tmp_path / "vba_source"),
+    )
+
+    assert exit_code == EXIT_USAGE_ERROR
+    assert [e["event"] for e in events] == ["error"]
+    assert sorted(events[0]["conflicts"]["Book1"]) == [
+        str(tmp_path / "a" / "Book1.xlsm"),
+        str(tmp_path / "b" / "Book1.xlsm"),
+    ]
+    assert not os.path.exists(tmp_path / "vba_source")
+
+
+def test_detect_source_encoding_looks_past_a_long_ascii_prefix():
+    """先頭が長いASCIIのみのUTF-8ファイルも、UTF-8と判定する"""
+    data = b"' x\r\n" * 20000 + "' café\r\n".encode("utf-8")
+
+    assert vba_exporter.detect_source_encoding(data, "cp932") == "utf-8"
+    assert vba_exporter.detect_source_encoding(b"' x\r\n", "cp932") == "cp932"
+    assert vba_exporter.detect_source_encoding(
+        "' 日本\r\n".encode("cp932"), "cp932"
+    ) == ("cp932")
@@ -1,17 +1,514 @@
 # ver 1.0.0 GitHub管理用にVBAをファイルに出力
 # ver 1.0.1 フォーマッター機能追加
 # ver 1.0.2 (フォーマッター更新)
+# ver 1.0.3 --profile オプションによるプロファイル計測モード
+# ver 1.0.4 オートメーションバックエンドの切り替えとExcel/VBEシミュレーター
+# ver 1.0.5 読み込み・整形・書き込みのパイプライン化とアトミックな書き込み
+# ver 1.0.6 内容のハッシュ値による重複排除ストアへの出力モード
+# ver 1.0.7 ヘッドレスCLI(--headless)とNDJSONでの進捗出力。GUIは共通の処理本体を利用
+# ver 1.0.8 ブック・エクスポート済みフォルダ同士を手続き単位で比較する --compare モード
+# ver 1.0.9 複数モジュールを一括整形する format_many（比較モードで使用）
+# ver 1.1.0 出力の文字コード指定(既定はシステムのANSIコードページ)と改行コードCRLF、BOM・バイト列による文字コード判定
 
 import os
-import win32com.client
 import sys
 import tkinter as tk
 from tkinter import filedialog, scrolledtext
 import threading
 import re
+import argparse
+import cProfile
+import pstats
+import io
+import time
+import collections
+import json
+import queue
+import tempfile
+import hashlib
+import glob
+import concurrent.futures
+import difflib
+import multiprocessing
+import mmap
+import codecs
+import ctypes
+import locale
+from typing import NamedTuple
+
+try:
+    import win32com.client
+    import pythoncom
+except ImportError:
+    # Windows以外の環境（CIでのシミュレーター実行等）ではpywin32を利用できない
+    win32com = pythoncom = None
+
+def get_ansi_code_page():
+    """
+    VBEがソースのインポート・エクスポートに使う、システムのANSIコードページを返す。
+    日本語環境ではcp932、英語環境ではcp1252となる。Windows以外ではロケールの文字コードを返す。
+    """
+    try:
+        encoding = f"cp{ctypes.windll.kernel32.GetACP()}"
+        codecs.lookup(encoding)
+        return encoding
+    except (AttributeError, OSError, LookupError):
+        return locale.getpreferredencoding(False)
+
 
 OUTPUT_BASE_FOLDER = "vba_source"
 VB_COMPONENT_TYPE = {1: ".bas", 2: ".cls", 3: ".frm", 100: ".cls"}
+PROFILE_FILE_PREFIX = "vba_exporter"
+PROFILE_TOP_N = 25  # --profile 時に出力する上位関数の件数
+EXPORT_FORMAT_WORKERS = 2  # 整形ワーカースレッド数
+EXPORT_QUEUE_SIZE = 16  # パイプラインの各段の間のキューの上限
+WRITE_BUFFER_SIZE = 1024 * 1024  # ファイル書き込みのバッファサイズ
+STORE_FOLDER_NAME = ".objects"  # 重複排除ストアのオブジェクト格納フォルダ
+STORE_INDEX_FILE_NAME = "index.json"  # ブックごとのコンポーネントとオブジェクトの対応表
+EXPORT_MANIFEST_FILE_NAME = ".vba_exporter.json"  # 出力先フォルダのエクスポート元と出力したファイル
+EXCEL_FILE_EXTENSIONS = (".xlsm", ".xlsb", ".xls")
+# ヘッドレス実行時の終了コード
+EXIT_OK = 0
+EXIT_EXPORT_FAILED = 1  # 1つ以上のブックでエクスポートに失敗した
+EXIT_USAGE_ERROR = 2  # 対象のブックが見つからない等、引数に問題がある
+EXIT_DIFFERENCES_FOUND = 1  # --compare: 比較した2つの間に差分がある
+DECLARATIONS_NAME = "(Declarations)"  # 最初の手続きより前の宣言部の名前
+COMPARE_CONTEXT_LINES = 3  # --compare: 差分に含める前後の行数
+FORMAT_MANY_WORKERS = max(1, min(4, (os.cpu_count() or 1) - 1))  # format_many の並列数
+FORMAT_MANY_CHUNK_LINES = 2000  # format_many で1タスクにまとめる行数の目安
+PARALLEL_FORMAT_MIN_LINES = 3000  # format_many: スレッドで並列化する合計行数の下限
+# format_many: プロセスで並列化する合計行数の下限。整形は約3µs/行、spawnでのプール起動は
+# 0.4〜0.6秒のため、2ワーカーで回収できるのは直列で1.2秒以上（約40万行）かかる場合に限られる
+PROCESS_FORMAT_MIN_LINES = 400_000
+# VBEのインポート・エクスポートと同じ、システムのANSIコードページ(日本語環境ではcp932)とCRLF
+SOURCE_ENCODING = get_ansi_code_page()
+SOURCE_NEWLINE = "\r\n"
+ENCODING_SAMPLE_BYTES = 64 * 1024  # 文字コード判定に使う、最初のASCII以外のバイトからのバイト数
+MMAP_READ_MIN_BYTES = 1024 * 1024  # このサイズ以上のファイルはメモリマップで読み込む
+
+
+def get_output_folder_name(excel_filepath):
+    """ブックの出力先フォルダ名（拡張子を除いたファイル名）を返す"""
+    return os.path.splitext(os.path.basename(excel_filepath))[0]
+
+
+class OutputFolderConflictError(ValueError):
+    """
+    複数のブックが同じ出力先フォルダに書き込むことになる場合のエラー。
+    conflictsは 出力先フォルダ名 -> ブックのパスのリスト。
+    """
+
+    def __init__(self, conflicts):
+        self.conflicts = conflicts
+        super().__init__(
+            "duplicate output folders: "
+            + "; ".join(f"{name}: {', '.join(paths)}" for name, paths in conflicts.items())
+        )
+
+
+def get_base_dir():
+    """実行環境（スクリプト or exe）に応じて基底ディレクトリを返す"""
+    if getattr(sys, "frozen", False) and hasattr(sys, "_MEIPASS"):
+        return os.path.dirname(sys.executable)
+    return os.path.dirname(os.path.abspath(__file__))
+
+
+def start_thread_profiling():
+    """
+    これ以降に開始するスレッドごとにcProfileを有効にし、そのプロファイラを格納するリストを返す。
+    計測を終えるときは threading.setprofile(None) を呼び出す。
+    Python 3.12以降は1つのプロファイラが全スレッドを計測するため、スレッドごとの有効化は行われない。
+    """
+    thread_profilers = []
+
+    def enable_thread_profiler(frame, event, arg):
+        sys.setprofile(None)
+        thread_profiler = cProfile.Profile()
+        try:
+            thread_profiler.enable()
+        except ValueError:
+            return  # 別のプロファイラが既に全スレッドを計測している
+        thread_profilers.append(thread_profiler)
+
+    threading.setprofile(enable_thread_profiler)
+    return thread_profilers
+
+
+def run_with_profile(target, output_dir, top_n=PROFILE_TOP_N, out=None):
+    """
+    targetをcProfileで計測しながら実行し、結果をoutput_dirに保存する。
+    計測中に開始したスレッド（パイプラインの整形・書き込みスレッド等）も計測し、結果を合算する。
+    保存後、内部時間の長い上位top_n件の関数をout（既定は標準出力）に表示する。
+    """
+    profiler = cProfile.Profile()
+    thread_profilers = start_thread_profiling()
+    try:
+        return profiler.runcall(target)
+    finally:
+        threading.setprofile(None)
+        timestamp = time.strftime("%Y%m%d_%H%M%S")
+        profile_path = os.path.join(
+            output_dir, f"{PROFILE_FILE_PREFIX}_{timestamp}_{os.getpid()}.prof"
+        )
+        try:
+            os.makedirs(output_dir, exist_ok=True)
+            stream = io.StringIO()
+            stats = pstats.Stats(profiler, stream=stream)
+            for thread_profiler in thread_profilers:
+                stats.add(thread_profiler)
+            stats.dump_stats(profile_path)
+            print(f"\n[プロファイル] 保存しました: {profile_path}", file=out)
+
+            stats.sort_stats(pstats.SortKey.TIME).print_stats(top_n)
+            print(f"[プロファイル] 処理時間の長い上位 {top_n} 関数:", file=out)
+            print(stream.getvalue(), file=out)
+        except Exception as e:
+            print(f"[警告] プロファイル結果の保存に失敗しました: {e}", file=sys.stderr)
+
+
+# --- オートメーションバックエンド (win32com / シミュレーター) ---
+class Win32ComBackend:
+    """pywin32を介して実際のExcelに接続するオートメーションバックエンド。"""
+
+    name = "win32com"
+
+    def initialize(self):
+        pythoncom.CoInitialize()
+
+    def uninitialize(self):
+        pythoncom.CoUninitialize()
+
+    def get_active_excel(self):
+        return win32com.client.GetActiveObject("Excel.Application")
+
+    def dispatch_excel(self):
+        return win32com.client.Dispatch("Excel.Application")
+
+    def dispatch_new_excel(self):
+        """既存のExcelに接続せず、常に新しいExcelプロセスを起動する"""
+        return win32com.client.DispatchEx("Excel.Application")
+
+
+class SimulatorStats:
+    """
+    シミュレーターへのCOM呼び出しを記録し、設定された遅延を発生させるクラス。
+    呼び出し1回ごとの固定遅延と、転送する1行ごとの遅延を設定できる。
+    """
+
+    def __init__(self, call_latency_ms: float = 0.0, line_latency_ms: float = 0.0):
+        self.call_latency_ms = call_latency_ms
+        self.line_latency_ms = line_latency_ms
+        self.call_counts = collections.Counter()
+        self._lock = threading.Lock()
+
+    def record(self, call_name: str, line_count: int = 0):
+        """COM呼び出し1回分を記録し、遅延を発生させる。"""
+        with self._lock:
+            self.call_counts[call_name] += 1
+        delay_ms = self.call_latency_ms + self.line_latency_ms * line_count
+        if delay_ms > 0:
+            time.sleep(delay_ms / 1000)
+
+    @property
+    def total_calls(self) -> int:
+        with self._lock:
+            return sum(self.call_counts.values())
+
+    def reset(self):
+        with self._lock:
+            self.call_counts.clear()
+
+    def summary(self) -> str:
+        with self._lock:
+            counts = ", ".join(f"{k}={v}" for k, v in sorted(self.call_counts.items()))
+            return f"total={sum(self.call_counts.values())} ({counts})"
+
+
+class SimulatedCodeModule:
+    """VBIDE.CodeModuleを模したクラス。行番号は1始まり。"""
+
+    def __init__(self, stats: SimulatorStats, code: str = "", parent=None):
+        self._stats = stats
+        self._lines = code.splitlines()
+        self._parent = parent
+
+    @property
+    def Parent(self):
+        self._stats.record("Parent")
+        return self._parent
+
+    @property
+    def CountOfLines(self):
+        self._stats.record("CountOfLines")
+        return len(self._lines)
+
+    def Lines(self, start_line, count):
+        self._stats.record("Lines", count)
+        return "\r\n".join(self._lines[start_line - 1 : start_line - 1 + count])
+
+    def DeleteLines(self, start_line, count=1):
+        self._stats.record("DeleteLines", count)
+        del self._lines[start_line - 1 : start_line - 1 + count]
+
+    def InsertLines(self, line, code):
+        # VBEと同様、末尾の改行や空文字列も1行として挿入する
+        new_lines = re.split(r"\r\n|\r|\n", code)
+        self._stats.record("InsertLines", len(new_lines))
+        self._lines[line - 1 : line - 1] = new_lines
+
+    def ReplaceLine(self, line, code):
+        self._stats.record("ReplaceLine", 1)
+        self._lines[line - 1] = code
+
+
+class SimulatedVBComponent:
+    """VBIDE.VBComponentを模したクラス。"""
+
+    def __init__(self, stats: SimulatorStats, name: str, component_type: int, code: str):
+        self._stats = stats
+        self._name = name
+        self._type = component_type
+        self._code_module = SimulatedCodeModule(stats, code, self)
+
+    @property
+    def Name(self):
+        self._stats.record("Name")
+        return self._name
+
+    @property
+    def Type(self):
+        self._stats.record("Type")
+        return self._type
+
+    @property
+    def CodeModule(self):
+        self._stats.record("CodeModule")
+        return self._code_module
+
+
+class SimulatedVBComponents:
+    """VBIDE.VBComponentsを模したクラス。Itemはインデックス(1始まり)と名前の両方に対応する。"""
+
+    def __init__(self, stats: SimulatorStats, components):
+        self._stats = stats
+        self._components = list(components)
+
+    def __iter__(self):
+        self._stats.record("_NewEnum")
+        return iter(list(self._components))
+
+    @property
+    def Count(self):
+        self._stats.record("Count")
+        return len(self._components)
+
+    def Item(self, index):
+        self._stats.record("Item")
+        if isinstance(index, int):
+            return self._components[index - 1]
+        for component in self._components:
+            if component._name.lower() == str(index).lower():
+                return component
+        raise KeyError(index)
+
+
+class SimulatedVBProject:
+    """VBIDE.VBProjectを模したクラス。"""
+
+    def __init__(self, stats: SimulatorStats, components):
+        self._stats = stats
+        self._components = SimulatedVBComponents(stats, components)
+
+    @property
+    def VBComponents(self):
+        self._stats.record("VBComponents")
+        return self._components
+
+
+class SimulatedWorkbook:
+    """Excel.Workbookを模したクラス。"""
+
+    def __init__(self, stats: SimulatorStats, full_name: str, components):
+        self._stats = stats
+        self._full_name = full_name
+        self._vb_project = SimulatedVBProject(stats, components)
+        self.closed = False
+
+    @property
+    def Name(self):
+        self._stats.record("Name")
+        return os.path.basename(self._full_name)
+
+    @property
+    def FullName(self):
+        self._stats.record("FullName")
+        return self._full_name
+
+    @property
+    def VBProject(self):
+        self._stats.record("VBProject")
+        return self._vb_project
+
+    def Close(self, SaveChanges=False):
+        self._stats.record("Close")
+        self.closed = True
+
+
+class SimulatedWorkbooks:
+    """
+    Excel.Workbooksを模したクラス。
+    Openには、事前に登録したブック、エクスポート済みソースのフォルダ、
+    またはコンポーネントを記述したJSONファイルのパスを指定できる。
+    """
+
+    def __init__(self, stats: SimulatorStats, application):
+        self._stats = stats
+        self._application = application
+        self._workbooks = []
+
+    def __iter__(self):
+        self._stats.record("_NewEnum")
+        return iter(list(self._workbooks))
+
+    @property
+    def Count(self):
+        self._stats.record("Count")
+        return len(self._workbooks)
+
+    def Open(self, path):
+        self._stats.record("Open")
+        workbook = self._application.backend.load_workbook(path)
+        self._workbooks.append(workbook)
+        self._application.active_workbook = workbook
+        return workbook
+
+
+class SimulatedVBE:
+    """VBIDE.VBEを模したクラス。アクティブなコードペインは持たない。"""
+
+    ActiveCodePane = None
+
+
+class SimulatedApplication:
+    """Excel.Applicationを模したクラス。"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._stats = backend.stats
+        self._workbooks = SimulatedWorkbooks(self._stats, self)
+        self.active_workbook = None
+        self.Visible = False
+        self.VBE = SimulatedVBE()
+
+    @property
+    def Workbooks(self):
+        self._stats.record("Workbooks")
+        return self._workbooks
+
+    @property
+    def ActiveWorkbook(self):
+        self._stats.record("ActiveWorkbook")
+        return self.active_workbook
+
+    def Quit(self):
+        self._stats.record("Quit")
+
+
+class SimulatedExcelBackend:
+    """
+    Windows以外でもエクスポート処理のベンチマークや回帰テストを行うための、
+    純Pythonで実装したExcel/VBEシミュレーターのバックエンド。
+    active_vba_formatter.py のシミュレーターと同じ構成。
+    """
+
+    name = "simulator"
+    EXTENSION_TYPES = {".bas": 1, ".cls": 2, ".frm": 3}
+
+    def __init__(self, call_latency_ms: float = 0.0, line_latency_ms: float = 0.0):
+        self.stats = SimulatorStats(call_latency_ms, line_latency_ms)
+        self.registered_workbooks = {}
+        self.application = SimulatedApplication(self)
+
+    def initialize(self):
+        pass
+
+    def uninitialize(self):
+        pass
+
+    def get_active_excel(self):
+        return self.application
+
+    def dispatch_excel(self):
+        return self.application
+
+    def dispatch_new_excel(self):
+        return SimulatedApplication(self)
+
+    def register_workbook(self, full_name: str, components):
+        """components: (コンポーネント名, 種類, コード) のリストでブックを登録する。"""
+        self.registered_workbooks[os.path.abspath(full_name)] = list(components)
+
+    def load_workbook(self, path: str) -> SimulatedWorkbook:
+        """登録済みブック、ソースフォルダ、またはJSONファイルからブックを生成する。"""
+        full_name = os.path.abspath(path)
+        if full_name in self.registered_workbooks:
+            specs = self.registered_workbooks[full_name]
+        elif os.path.isdir(full_name):
+            specs = []
+            for file_name in sorted(os.listdir(full_name)):
+                name, ext = os.path.splitext(file_name)
+                if ext.lower() not in self.EXTENSION_TYPES:
+                    continue
+                code = read_source_file(os.path.join(full_name, file_name))
+                specs.append((name, self.EXTENSION_TYPES[ext.lower()], code))
+        elif os.path.isfile(full_name):
+            with open(full_name, encoding="utf-8") as f:
+                data = json.load(f)
+            specs = [(c["name"], c.get("type", 1), c["code"]) for c in data["components"]]
+        else:
+            raise FileNotFoundError(path)
+
+        components = [
+            SimulatedVBComponent(self.stats, name, component_type, code)
+            for name, component_type, code in specs
+        ]
+        return SimulatedWorkbook(self.stats, full_name, components)
+
+
+_automation_backend = None
+
+
+def get_automation_backend():
+    """
+    現在のオートメーションバックエンドを返す。
+    未設定の場合、環境変数 VBA_AUTOMATION_BACKEND=simulator であればシミュレーターを、
+    それ以外はwin32comを使用する。
+    """
+    global _automation_backend
+    if _automation_backend is None:
+        if os.environ.get("VBA_AUTOMATION_BACKEND", "").lower() == "simulator":
+            _automation_backend = SimulatedExcelBackend(
+                float(os.environ.get("VBA_SIM_CALL_MS", "0")),
+                float(os.environ.get("VBA_SIM_LINE_MS", "0")),
+            )
+        else:
+            _automation_backend = Win32ComBackend()
+    return _automation_backend
+
+
+def set_automation_backend(backend):
+    """オートメーションバックエンドを差し替える（ベンチマーク・テスト用）。"""
+    global _automation_backend
+    _automation_backend = backend
+
+
+class FormatResult(NamedTuple):
+    """format_manyが返す、1モジュール分の整形結果と統計"""
+
+    formatted_code: str
+    line_count: int  # 元コードの行数
+    changed_lines: int  # インデントの変更・空行の除去により変わった元コードの行数
+    seconds: float  # 整形に要した時間
 
 
 # --- ▼ [手順1] 完成したVbaFormatterクラスをここに追加 ▼ ---
@@ -103,15 +600,851 @@ class VbaFormatter:
 
         return "\n".join(formatted_lines)
 
+    def format_with_stats(self, code_string: str) -> FormatResult:
+        """コードを整形し、整形結果と行数・変更行数・所要時間を返す。"""
+        start_time = time.perf_counter()
+        lines = code_string.splitlines()
+        formatted_code = self.format_code(code_string)
+        formatted_lines = formatted_code.split("\n") if formatted_code else []
+        # 整形は行の追加・並べ替えを行わず、連続する空行を除去するだけなので、
+        # 先頭から順に対応付ければ変更行数を差分計算なしで数えられる
+        changed_lines, position = 0, 0
+        for line in lines:
+            if not line.strip() and (
+                position >= len(formatted_lines) or formatted_lines[position] != ""
+            ):
+                changed_lines += 1
+                continue
+            if formatted_lines[position] != line:
+                changed_lines += 1
+            position += 1
+        return FormatResult(
+            formatted_code, len(lines), changed_lines, time.perf_counter() - start_time
+        )
+
+    def format_many(self, modules, workers=FORMAT_MANY_WORKERS):
+        """
+        複数のモジュールのコードをまとめて整形し、入力と同じ順序でFormatResultのリストを返す。
+        小さなモジュールはFORMAT_MANY_CHUNK_LINES行程度のチャンクにまとめて1タスクとする。
+        GILの無いフリースレッド版CPythonではスレッド、それ以外ではプロセスで並列に整形する。
+        プロセスの起動コストを回収できない合計行数（PROCESS_FORMAT_MIN_LINES未満）は直列で処理する。
+        整形中に変更されるインスタンスの状態は無いため、複数のスレッドから共有して使用できる。
+        """
+        modules = list(modules)
+        chunks, chunk, chunk_lines, total_lines = [], [], 0, 0
+        for code_string in modules:
+            line_count = code_string.count("\n") + 1
+            chunk.append(code_string)
+            chunk_lines += line_count
+            total_lines += line_count
+            if chunk_lines >= FORMAT_MANY_CHUNK_LINES:
+                chunks.append(chunk)
+                chunk, chunk_lines = [], 0
+        if chunk:
+            chunks.append(chunk)
+
+        if is_free_threaded():
+            executor_class = concurrent.futures.ThreadPoolExecutor
+            min_lines = PARALLEL_FORMAT_MIN_LINES
+        else:
+            executor_class = concurrent.futures.ProcessPoolExecutor
+            min_lines = PROCESS_FORMAT_MIN_LINES
+        if workers <= 1 or len(chunks) <= 1 or total_lines < min_lines:
+            return _format_chunk(self, modules)
+
+        with executor_class(max_workers=min(workers, len(chunks))) as executor:
+            futures = [executor.submit(_format_chunk, self, chunk) for chunk in chunks]
+            return [result for future in futures for result in future.result()]
+
+
+def _format_chunk(formatter, modules):
+    """format_manyのワーカーで、チャンク内のモジュールを順に整形する"""
+    return [formatter.format_with_stats(code_string) for code_string in modules]
+
+
+def is_free_threaded():
+    """GILが無効なフリースレッド版CPythonで実行されているかを返す"""
+    is_gil_enabled = getattr(sys, "_is_gil_enabled", None)
+    return is_gil_enabled is not None and not is_gil_enabled()
+
+
+def write_file_atomic(path, data):
+    """
+    同じフォルダの一時ファイルに書き込んでから置き換えることで、
+    書き込み途中のファイルが残らないようにする。dataはstrまたはbytes。
+    """
+    fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path) or ".", prefix=".tmp_", suffix=os.path.splitext(path)[1]
+    )
+    try:
+        if isinstance(data, bytes):
+            with os.fdopen(fd, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+                f.write(data)
+        else:
+            with os.fdopen(fd, "w", encoding="utf-8", buffering=WRITE_BUFFER_SIZE) as f:
+                f.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+UTF8_SEQUENCE_PATTERN = re.compile(
+    rb"[\xc2-\xdf][\x80-\xbf]|[\xe0-\xef][\x80-\xbf]{2}|[\xf0-\xf4][\x80-\xbf]{3}"
+)
+NON_ASCII_BYTES = bytes(range(0x80, 0x100))
+NON_ASCII_PATTERN = re.compile(rb"[\x80-\xff]")
+
+
+def detect_source_encoding(data, default_encoding=SOURCE_ENCODING):
+    """
+    BOMとバイトの並びから文字コードを判定する。試しにデコードすることはしない。
+    BOMが無く、ASCII以外のバイトが全て正しいUTF-8の並びであればUTF-8、
+    それ以外（ASCIIのみを含む）はdefault_encodingとみなす。dataはbytesまたはmmap。
+    ASCIIのみの部分は判定に影響しないため、最初のASCII以外のバイトから
+    ENCODING_SAMPLE_BYTESを標本とする（先頭が長いASCIIのみのファイルも正しく判定できる）。
+    """
+    head = data[:3]
+    if head == b"\xef\xbb\xbf":
+        return "utf-8-sig"
+    if head[:2] in (b"\xff\xfe", b"\xfe\xff"):
+        return "utf-16"
+
+    match = NON_ASCII_PATTERN.search(data)
+    if match is None:
+        return default_encoding
+    sample_end = match.start() + ENCODING_SAMPLE_BYTES
+    sample = data[match.start() : sample_end]
+    if len(data) > sample_end:
+        # 標本の末尾で途切れた文字は判定から除く
+        sample = sample.rstrip(NON_ASCII_BYTES)
+    non_ascii_count = len(sample) - len(sample.translate(None, NON_ASCII_BYTES))
+    if non_ascii_count == 0:
+        return default_encoding
+    utf8_count = sum(len(sequence) for sequence in UTF8_SEQUENCE_PATTERN.findall(sample))
+    if utf8_count == non_ascii_count:
+        return "utf-8"
+    return default_encoding
+
+
+def encode_source(text, encoding=SOURCE_ENCODING):
+    """モジュールのコードを、VBEが扱える文字コードとCRLF（最終行も改行で終わる）のバイト列にする"""
+    lines = text.splitlines()
+    if not lines:
+        return b""
+    return (SOURCE_NEWLINE.join(lines) + SOURCE_NEWLINE).encode(encoding)
+
+
+def read_source_file(path, default_encoding=SOURCE_ENCODING):
+    """
+    モジュールのファイルを、文字コードを判定して読み込む。改行は\nに統一する。
+    MMAP_READ_MIN_BYTES以上のファイルは、メモリマップから直接デコードする。
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size < MMAP_READ_MIN_BYTES:
+            data = f.read()
+            text = data.decode(detect_source_encoding(data, default_encoding), "replace")
+        else:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                encoding = detect_source_encoding(mapped, default_encoding)
+                with memoryview(mapped) as view:
+                    text = str(view, encoding, "replace")
+    return text.replace("\r\n", "\n").replace("\r", "\n")
+
+
+class ContentAddressedStore:
+    """
+    整形済みモジュールを内容のハッシュ値をキーとして1度だけ保存するオブジェクトストア。
+    複数のブックで共有されている同一モジュールは1つのオブジェクトにまとめられ、
+    既に存在するオブジェクトは再エクスポート時に書き込まない。
+    オブジェクトは <root>/<ハッシュ先頭2文字>/<ハッシュ> に保存する。
+    """
+
+    def __init__(self, root, encoding=SOURCE_ENCODING):
+        self.root = root
+        self.encoding = encoding
+        self._lock = threading.Lock()
+        self.new_objects = 0
+        self.reused_objects = 0
+
+    def object_path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def put(self, text):
+        """テキストを保存し、そのハッシュ値を返す。既に存在する場合は書き込まない"""
+        # 通常のファイル出力と同じ文字コード・改行コードのバイト列にする
+        data = encode_source(text, self.encoding)
+        digest = hashlib.sha256(data).hexdigest()
+        object_path = self.object_path(digest)
+        if os.path.exists(object_path):
+            with self._lock:
+                self.reused_objects += 1
+            return digest
+
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        try:
+            write_file_atomic(object_path, data)
+        except OSError:
+            # 別スレッド・別プロセスが同じオブジェクトを同時に書き込んだ場合
+            if not os.path.exists(object_path):
+                raise
+        with self._lock:
+            self.new_objects += 1
+        return digest
+
+    def write_index(self, output_folder, workbook_name, entries):
+        """ブックのフォルダに、ファイル名とオブジェクトのハッシュ値の対応表を書き込む"""
+        index = {
+            "workbook": workbook_name,
+            "algorithm": "sha256",
+            "encoding": self.encoding,
+            "objects": os.path.relpath(self.root, output_folder).replace(os.sep, "/"),
+            "components": dict(sorted(entries.items())),
+        }
+        write_file_atomic(
+            os.path.join(output_folder, STORE_INDEX_FILE_NAME),
+            json.dumps(index, ensure_ascii=False, indent=2) + "\n",
+        )
+
+
+class ProcedureIndex:
+    """
+    整形済みモジュールを手続き単位に分割し、手続きごとのハッシュ値を持つ索引。
+    最初の手続きより前は宣言部として扱い、手続きの間にあるコメント行は直後の手続きに含める。
+    モジュール全体のハッシュ値が一致すれば、手続き単位の比較は不要となる。
+    """
+
+    PROCEDURE_PATTERN = re.compile(
+        r"^(?:(?:public|private|friend)\s+)?(?:static\s+)?"
+        r"(sub|function|property\s+(?:get|let|set))\s+(\w+)",
+        re.IGNORECASE,
+    )
+    PROCEDURE_END_PATTERN = re.compile(r"^end\s+(?:sub|function|property)\b", re.IGNORECASE)
+
+    def __init__(self, formatted_code):
+        lines = formatted_code.splitlines()
+        self.digest = hashlib.sha256("\n".join(lines).encode("utf-8")).hexdigest()
+        # 手続き名 -> (ハッシュ値, 開始行, 行のリスト)。挿入順はモジュール内の順序
+        self.procedures = {}
+
+        name, start_line, segment = DECLARATIONS_NAME, 1, []
+        in_procedure, pending = False, []
+        for line_number, line in enumerate(lines, start=1):
+            stripped_line = line.strip()
+            match = None if in_procedure else self.PROCEDURE_PATTERN.match(stripped_line)
+            if match:
+                if name == DECLARATIONS_NAME:
+                    self._add(name, start_line, segment)
+                # 手続きの直前のコメント行は、その手続きに含める
+                while pending and not pending[0].strip():
+                    pending.pop(0)
+                kind = " ".join(match.group(1).split()).title()
+                name, start_line = f"{kind} {match.group(2)}", line_number - len(pending)
+                segment, pending, in_procedure = pending + [line], [], True
+            elif in_procedure:
+                segment.append(line)
+                if self.PROCEDURE_END_PATTERN.match(stripped_line):
+                    self._add(name, start_line, segment)
+                    in_procedure = False
+            elif name == DECLARATIONS_NAME:
+                segment.append(line)
+            else:
+                pending.append(line)
+
+        if in_procedure or name == DECLARATIONS_NAME:
+            self._add(name, start_line, segment)
+        elif any(line.strip() for line in pending):
+            # 最後の手続きより後ろの行は、最後の手続きに含める
+            self._add(name, start_line, segment + pending)
+
+    def _add(self, name, start_line, segment):
+        while segment and not segment[-1].strip():
+            segment = segment[:-1]
+        if not segment:
+            return
+        digest = hashlib.sha256("\n".join(segment).encode("utf-8")).hexdigest()
+        self.procedures[name] = (digest, start_line, segment)
+
+
+def compare_procedure_indexes(left, right, context=COMPARE_CONTEXT_LINES):
+    """
+    2つの手続き索引を手続き名で対応付け、ハッシュ値が異なる手続きの差分を返す。
+    対応付けは辞書の参照のみで行うため、手続き数に対して線形時間で比較できる。
+    片側にしか無いモジュールは、もう一方にNoneを指定する。
+    """
+    left_procedures = left.procedures if left is not None else {}
+    right_procedures = right.procedures if right is not None else {}
+    changes = []
+    for name, (digest, start_line, lines) in left_procedures.items():
+        other = right_procedures.get(name)
+        if other is None:
+            changes.append({"procedure": name, "status": "removed", "left_line": start_line})
+        elif other[0] != digest:
+            diff = difflib.unified_diff(
+                lines,
+                other[2],
+                f"left:{name}",
+                f"right:{name}",
+                n=context,
+                lineterm="",
+            )
+            changes.append({
+                "procedure": name,
+                "status": "modified",
+                "left_line": start_line,
+                "right_line": other[1],
+                "diff": list(diff),
+            })
+    for name, (digest, start_line, lines) in right_procedures.items():
+        if name not in left_procedures:
+            changes.append({"procedure": name, "status": "added", "right_line": start_line})
+    return changes
+
+
+def remove_stale_exports(output_folder, source_path, keep_files):
+    """
+    このツールが同じブックから前回エクスポートしたファイルのうち、keep_filesに含まれないもの
+    （ブックから削除したコンポーネントや、ストア出力と通常の出力の切り替えで不要になった対応表）を
+    削除し、今回出力したファイルをフォルダの記録(EXPORT_MANIFEST_FILE_NAME)に書き込む。
+    記録の無いフォルダや、記録されたエクスポート元が別のブックであるフォルダのファイルは削除しない。
+    戻り値: 記録されていたエクスポート元が別のブックの場合はそのパス、それ以外はNone
+    """
+    manifest_path = os.path.join(output_folder, EXPORT_MANIFEST_FILE_NAME)
+    source_path = os.path.abspath(source_path)
+    try:
+        with open(manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+
+    owner = None
+    previous_source = manifest.get("source")
+    if previous_source and os.path.normcase(previous_source) != os.path.normcase(source_path):
+        owner = previous_source
+    elif previous_source:
+        extensions = set(VB_COMPONENT_TYPE.values())
+        for file_name in manifest.get("files", ()):
+            # 記録が書き換えられていても、フォルダ内のモジュールと対応表以外は削除しない
+            if file_name in keep_files or os.path.basename(file_name) != file_name:
+                continue
+            extension = os.path.splitext(file_name)[1].lower()
+            if file_name == STORE_INDEX_FILE_NAME or extension in extensions:
+                try:
+                    os.remove(os.path.join(output_folder, file_name))
+                except FileNotFoundError:
+                    pass
+
+    manifest = {"source": source_path, "files": sorted(keep_files)}
+    write_file_atomic(manifest_path, json.dumps(manifest, ensure_ascii=False, indent=2) + "\n")
+    return owner
+
+
+def read_export_folder(folder, default_encoding=SOURCE_ENCODING):
+    """
+    エクスポート済みのブックのフォルダから、ファイル名とコードの対応を読み込む。
+    重複排除ストアの対応表(index.json)がある場合は、ストアのオブジェクトを参照する。
+    文字コードはファイルごとに判定し、判定できない場合は対応表に記録された文字コード、
+    またはdefault_encodingとみなす。
+    """
+    index_path = os.path.join(folder, STORE_INDEX_FILE_NAME)
+    if os.path.isfile(index_path):
+        with open(index_path, encoding="utf-8") as f:
+            index = json.load(f)
+        default_encoding = index.get("encoding", default_encoding)
+        store = ContentAddressedStore(os.path.normpath(os.path.join(folder, index["objects"])))
+        file_paths = {
+            file_name: store.object_path(digest)
+            for file_name, digest in index["components"].items()
+        }
+    else:
+        extensions = set(VB_COMPONENT_TYPE.values())
+        file_paths = {
+            file_name: os.path.join(folder, file_name)
+            for file_name in sorted(os.listdir(folder))
+            if os.path.splitext(file_name)[1].lower() in extensions
+        }
+
+    return {
+        file_name: read_source_file(file_path, default_encoding)
+        for file_name, file_path in file_paths.items()
+    }
+
+
+class ExportPipeline:
+    """
+    COMからの読み込み・整形・ファイル書き込みを並行して行うパイプライン。
+    読み込みは呼び出し元（COMを初期化したスレッド）がput()で投入し、
+    整形はワーカースレッド、書き込みは専用のライタースレッドが担当する。
+    各段は上限付きキューでつながっているため、最も遅い段に合わせて流量が制御され、
+    エクスポート時間は各段の合計ではなく最も遅い段の時間に近づく。
+    storeを指定した場合、ファイルの代わりにオブジェクトストアへ書き込み、
+    ファイル名とハッシュ値の対応をindex_entriesに記録する。
+    警告・エラーはreport(イベント名, **項目)で通知する。
+    """
+
+    _SENTINEL = None
+
+    def __init__(
+        self,
+        formatter,
+        store=None,
+        report=None,
+        workers=EXPORT_FORMAT_WORKERS,
+        queue_size=EXPORT_QUEUE_SIZE,
+        encoding=SOURCE_ENCODING,
+    ):
+        self.formatter = formatter
+        self.store = store
+        self.encoding = encoding
+        self.report = report or (lambda event, **fields: None)
+        self.index_entries = {}
+        self.format_queue = queue.Queue(maxsize=queue_size)
+        self.write_queue = queue.Queue(maxsize=queue_size)
+        self.write_errors = []
+        self.closed = False
+        self.format_threads = [
+            threading.Thread(target=self._format_worker, daemon=True) for _ in range(workers)
+        ]
+        self.writer_thread = threading.Thread(target=self._write_worker, daemon=True)
+        for thread in self.format_threads:
+            thread.start()
+        self.writer_thread.start()
+
+    def put(self, component_name, original_code, output_filepath):
+        """読み込んだモジュールを整形段へ渡す。キューが一杯の場合は空くまで待つ"""
+        self.format_queue.put((component_name, original_code, output_filepath))
+
+    def close(self):
+        """全ての整形と書き込みが終わるまで待ち、書き込みに全て成功したかを返す"""
+        if not self.closed:
+            self.closed = True
+            for _ in self.format_threads:
+                self.format_queue.put(self._SENTINEL)
+            for thread in self.format_threads:
+                thread.join()
+            self.write_queue.put(self._SENTINEL)
+            self.writer_thread.join()
+        return not self.write_errors
+
+    def _format_worker(self):
+        while True:
+            item = self.format_queue.get()
+            if item is self._SENTINEL:
+                return
+            component_name, original_code, output_filepath = item
+            try:
+                # --- ▼ [手順4] 新しいフォーマッターを呼び出す ▼ ---
+                formatted_code = self.formatter.format_code(original_code)
+            except Exception as e:
+                self.report("format_warning", component=component_name, error=str(e))
+                formatted_code = original_code
+            self.write_queue.put((component_name, formatted_code, output_filepath))
+
+    def _write_worker(self):
+        while True:
+            item = self.write_queue.get()
+            if item is self._SENTINEL:
+                return
+            component_name, formatted_code, output_filepath = item
+            try:
+                if self.store is not None:
+                    digest = self.store.put(formatted_code)
+                    self.index_entries[os.path.basename(output_filepath)] = digest
+                else:
+                    write_file_atomic(
+                        output_filepath, encode_source(formatted_code, self.encoding)
+                    )
+            except Exception as e:
+                self.report("write_error", component=component_name, error=str(e))
+                self.write_errors.append((component_name, e))
+
+
+class VbaExportEngine:
+    """
+    GUIとヘッドレスCLIで共通のエクスポート処理本体。
+    処理の進捗は、progressコールバックへイベント(dict)として通知する。
+    jobsに2以上を指定した場合、jobs個のワーカーがそれぞれ専用のExcelプロセスを起動し、並列に処理する。
+    モジュールはencodingの文字コードとCRLFで書き込む。
+    """
+
+    def __init__(
+        self,
+        output_dir,
+        progress=None,
+        use_store=False,
+        jobs=1,
+        formatter=None,
+        backend=None,
+        encoding=SOURCE_ENCODING,
+    ):
+        self.output_dir = output_dir
+        self.progress = progress or (lambda event: None)
+        self.jobs = max(1, jobs)
+        self.formatter = formatter or VbaFormatter()
+        self.backend = backend or get_automation_backend()
+        self.encoding = encoding
+        self.store = None
+        if use_store:
+            self.store = ContentAddressedStore(
+                os.path.join(output_dir, STORE_FOLDER_NAME), encoding
+            )
+        self._progress_lock = threading.Lock()
+        self._worker_state = threading.local()  # --jobs 並列時のワーカーごとのExcel
+
+    def report(self, event, **fields):
+        """進捗イベントを通知する。複数スレッドから呼ばれても順に通知する"""
+        with self._progress_lock:
+            self.progress({"event": event, **fields})
+
+    def export_workbooks(self, excel_filepaths):
+        """全てのブックをエクスポートし、失敗したブックの数を返す"""
+        excel_filepaths = list(excel_filepaths)
+        start_time = time.perf_counter()
+        self.report(
+            "start", total=len(excel_filepaths), output_dir=self.output_dir, jobs=self.jobs
+        )
+
+        if self.jobs == 1:
+            results = [self.export_workbook(path) for path in excel_filepaths]
+        else:
+            path_queue = queue.Queue()
+            for index, path in enumerate(excel_filepaths):
+                path_queue.put((index, path))
+            results = [False] * len(excel_filepaths)
+            workers = [
+                threading.Thread(target=self._export_worker, args=(path_queue, results))
+                for _ in range(min(self.jobs, len(excel_filepaths)))
+            ]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+
+        failed = results.count(False)
+        summary = {
+            "total": len(results),
+            "succeeded": len(results) - failed,
+            "failed": failed,
+            "seconds": round(time.perf_counter() - start_time, 3),
+        }
+        if self.store is not None:
+            summary["new_objects"] = self.store.new_objects
+            summary["reused_objects"] = self.store.reused_objects
+        self.report("done", **summary)
+        return failed
+
+    def _export_worker(self, path_queue, results):
+        """
+        --jobs 並列時のワーカースレッド。COMの初期化と専用のExcelプロセスの起動を1度だけ行い、
+        キューから取り出したブックを順に処理する。Excelの起動はブックごとではなくワーカーごととなる。
+        失敗したブックの後は、Excelの状態が不明なため終了し、次のブックで起動し直す。
+        """
+        self.backend.initialize()
+        self._worker_state.excel = None
+        try:
+            while True:
+                try:
+                    index, path = path_queue.get_nowait()
+                except queue.Empty:
+                    return
+                results[index] = self.export_workbook(path)
+                if not results[index]:
+                    self._quit_worker_excel(path)
+        finally:
+            self._quit_worker_excel(None)
+            self.backend.uninitialize()
+
+    def _quit_worker_excel(self, path):
+        """ワーカーが保持しているExcelを終了する"""
+        excel, self._worker_state.excel = self._worker_state.excel, None
+        if excel is not None:
+            try:
+                excel.Quit()
+            except Exception as e:
+                self.report("quit_warning", path=path, error=str(e))
+
+    def export_workbook(self, excel_filepath):
+        """
+        1つのブックをエクスポートする。COMは呼び出したスレッドごとに初期化する。
+        --jobs 並列時は、ワーカーが初期化済みのCOMとExcelを使用する。
+        """
+        if not os.path.isfile(excel_filepath):
+            self.report("missing", path=excel_filepath)
+            return False
+
+        output_folder = os.path.join(self.output_dir, get_output_folder_name(excel_filepath))
+
+        start_time = time.perf_counter()
+        self.report("workbook_start", path=excel_filepath)
+        if self.jobs > 1:
+            succeeded, component_count, error = self.export_vba_from_file(
+                excel_filepath, output_folder
+            )
+        else:
+            self.backend.initialize()
+            try:
+                succeeded, component_count, error = self.export_vba_from_file(
+                    excel_filepath, output_folder
+                )
+            finally:
+                self.backend.uninitialize()
+
+        result = {
+            "path": excel_filepath,
+            "ok": succeeded,
+            "components": component_count,
+            "seconds": round(time.perf_counter() - start_time, 3),
+        }
+        if error:
+            result["error"] = error
+        self.report("workbook_done", **result)
+        return succeeded
+
+    def export_vba_from_file(self, excel_filepath, output_folder):
+        """
+        指定されたExcelファイルからVBAコードをエクスポートする。
+        このスレッドはCOMからの読み込みのみを行い、整形と書き込みはExportPipelineに任せる。
+        ストア使用時は、モジュールはオブジェクトストアへ保存し、
+        output_folderにはコンポーネントとオブジェクトの対応表のみを書き込む。
+        戻り値: (成功したか, 出力したコンポーネント数, エラー内容)
+        """
+        excel = None
+        pipeline = None
+        component_count = 0
+        try:
+            # 並列実行時は、他のワーカーとExcelを共有しないようワーカーごとに別プロセスを起動し、
+            # そのワーカーが処理する後続のブックでも使い回す（終了は_export_workerが行う）
+            if self.jobs > 1:
+                if self._worker_state.excel is None:
+                    self._worker_state.excel = self.backend.dispatch_new_excel()
+                excel = self._worker_state.excel
+            else:
+                excel = self.backend.dispatch_excel()
+            excel.Visible = False
+            workbook = excel.Workbooks.Open(excel_filepath)
+
+            self.report("opened", path=excel_filepath)
+            os.makedirs(output_folder, exist_ok=True)
+
+            pipeline = ExportPipeline(
+                self.formatter,
+                self.store,
+                lambda event, **fields: self.report(event, path=excel_filepath, **fields),
+                encoding=self.encoding,
+            )
+            exported_files = set()
+            for component_name, file_name, code in self.iter_workbook_modules(workbook):
+                pipeline.put(component_name, code, os.path.join(output_folder, file_name))
+                exported_files.add(file_name)
+                component_count += 1
+
+            pipeline_succeeded = pipeline.close()
+            index_entries = pipeline.index_entries
+            pipeline = None
+            workbook.Close(SaveChanges=False)
+            if not pipeline_succeeded:
+                return False, component_count, "write failed"
+            if self.store is not None:
+                self.store.write_index(
+                    output_folder, os.path.basename(excel_filepath), index_entries
+                )
+                exported_files = {STORE_INDEX_FILE_NAME}
+            owner = remove_stale_exports(output_folder, excel_filepath, exported_files)
+            if owner is not None:
+                self.report(
+                    "cleanup_skipped", path=excel_filepath, folder=output_folder, owner=owner
+                )
+            return True, component_count, None
+        except Exception as e:
+            return False, component_count, str(e)
+        finally:
+            if pipeline is not None:
+                pipeline.close()
+            if excel and self.jobs == 1:
+                try:
+                    excel.Quit()
+                except Exception as e:
+                    self.report("quit_warning", path=excel_filepath, error=str(e))
+
+
+    def iter_workbook_modules(self, workbook):
+        """ブックのコードのあるコンポーネントを(コンポーネント名, ファイル名, コード)として順に読み込む"""
+        for component in workbook.VBProject.VBComponents:
+            ext = VB_COMPONENT_TYPE.get(component.Type)
+            if not ext:
+                continue
+            component_name = component.Name
+            code_module = component.CodeModule
+            line_count = code_module.CountOfLines
+            if line_count > 0:
+                yield component_name, f"{component_name}{ext}", code_module.Lines(1, line_count)
+
+    def read_snapshot(self, path):
+        """
+        ブックまたはエクスポート済みフォルダから、ファイル名とコードの対応を読み込む。
+        ブックはエクスポートと同じ経路でCOMから読み込む。
+        読み込み後にブックを閉じてExcelを終了するため、ユーザーが起動しているExcelには接続せず、
+        専用のExcelプロセスを起動する（開いているブックの未保存の編集を破棄しないため）。
+        """
+        if os.path.isdir(path):
+            return read_export_folder(path, self.encoding)
+
+        excel = None
+        self.backend.initialize()
+        try:
+            excel = self.backend.dispatch_new_excel()
+            excel.Visible = False
+            workbook = excel.Workbooks.Open(os.path.abspath(path))
+            modules = {
+                file_name: code
+                for _, file_name, code in self.iter_workbook_modules(workbook)
+            }
+            workbook.Close(SaveChanges=False)
+            return modules
+        finally:
+            if excel:
+                try:
+                    excel.Quit()
+                except Exception as e:
+                    self.report("quit_warning", path=path, error=str(e))
+            self.backend.uninitialize()
+
+    def compare(self, left_path, right_path):
+        """
+        2つのブック・エクスポート済みフォルダを整形した上で手続き単位で比較し、
+        差分をmodule_diff・procedure_diffイベントとして通知する。差分のあったモジュール数を返す。
+        モジュール全体のハッシュ値が一致するモジュールは、手続き単位の比較を省略する。
+        """
+        start_time = time.perf_counter()
+        self.report("compare_start", left=left_path, right=right_path)
+        left_modules = self.read_snapshot(left_path)
+        right_modules = self.read_snapshot(right_path)
+
+        # 両側の全モジュールを1度にまとめて整形する
+        sides = [(0, name) for name in left_modules] + [(1, name) for name in right_modules]
+        results = self.formatter.format_many(
+            [left_modules[name] if side == 0 else right_modules[name] for side, name in sides]
+        )
+        indexes = {
+            key: ProcedureIndex(result.formatted_code) for key, result in zip(sides, results)
+        }
+
+        summary = collections.Counter()
+        for file_name in dict.fromkeys([*left_modules, *right_modules]):
+            left_index = indexes.get((0, file_name))
+            right_index = indexes.get((1, file_name))
+            if left_index is not None and right_index is not None:
+                if left_index.digest == right_index.digest:
+                    summary["identical_modules"] += 1
+                    continue
+                status = "modified"
+            else:
+                status = "added" if left_index is None else "removed"
+
+            changes = compare_procedure_indexes(left_index, right_index)
+            if not changes:
+                # 手続きの間の空行のみが異なる場合
+                summary["identical_modules"] += 1
+                continue
+            self.report("module_diff", component=file_name, status=status, procedures=len(changes))
+            for change in changes:
+                self.report("procedure_diff", component=file_name, **change)
+            summary["changed_modules"] += 1
+            summary["changed_procedures"] += len(changes)
+
+        self.report(
+            "compare_done",
+            left=left_path,
+            right=right_path,
+            identical_modules=summary["identical_modules"],
+            changed_modules=summary["changed_modules"],
+            changed_procedures=summary["changed_procedures"],
+            seconds=round(time.perf_counter() - start_time, 3),
+        )
+        return summary["changed_modules"]
+
+
+def format_progress_message(event):
+    """進捗イベントをGUIのログに表示するメッセージに変換する"""
+    name = event["event"]
+    if name == "start":
+        return "VBAエクスポート処理を開始します..."
+    if name == "missing":
+        return f"[警告] 指定されたファイルが見つかりません: {event['path']}"
+    if name == "workbook_start":
+        return f"\nファイルを処理中: {event['path']}"
+    if name == "opened":
+        return f"  [処理中] {os.path.basename(event['path'])}"
+    if name == "format_warning":
+        return f"    - [警告] {event['component']} のインデント整形に失敗: {event['error']}"
+    if name == "write_error":
+        return f"    - [エラー] {event['component']} の書き込みに失敗: {event['error']}"
+    if name == "cleanup_skipped":
+        return (
+            f"  [警告] {event['folder']} は別のブック ({event['owner']}) の出力先のため、"
+            "前回の出力ファイルを削除しませんでした"
+        )
+    if name == "quit_warning":
+        return f"  [警告] Excelの終了処理中にエラーが発生しました: {event['error']}"
+    if name == "workbook_done":
+        workbook_name = os.path.basename(event["path"])
+        if event["ok"]:
+            return f"  [完了] {workbook_name} ({event['seconds']:.1f}秒)"
+        return f"  [エラー] {workbook_name} の処理中にエラーが発生: {event.get('error')}"
+    if name == "done":
+        message = "\nすべての処理が完了しました。"
+        if "new_objects" in event:
+            message += (
+                f"\nストア: 新規オブジェクト {event['new_objects']} 件 / "
+                f"既存オブジェクトの再利用 {event['reused_objects']} 件"
+            )
+        if event["failed"]:
+            message += "\nいくつかのファイルでエラーが発生しました。詳細は上記のログを確認してください。"
+        return message
+    if name == "compare_start":
+        return f"比較: {event['left']} <-> {event['right']}"
+    if name == "module_diff":
+        return f"\n[{event['status']}] {event['component']} (手続き {event['procedures']} 件)"
+    if name == "procedure_diff":
+        lines = [f"  [{event['status']}] {event['procedure']}"]
+        lines += [f"    {line}" for line in event.get("diff", ())]
+        return "\n".join(lines)
+    if name == "compare_done":
+        return (
+            f"\n比較完了: 差分のあるモジュール {event['changed_modules']} 件 / "
+            f"手続き {event['changed_procedures']} 件 / "
+            f"一致したモジュール {event['identical_modules']} 件 ({event['seconds']:.2f}秒)"
+        )
+    if name == "error":
+        return f"[エラー] {event['error']}"
+    return None
+
 
 class VbaExporterApp:
-    def __init__(self, root):
+    """エクスポート処理本体(VbaExportEngine)を操作するGUI"""
+
+    def __init__(
+        self,
+        root,
+        profile=False,
+        profile_top=PROFILE_TOP_N,
+        use_store=False,
+        encoding=SOURCE_ENCODING,
+    ):
         self.root = root
+        self.profile = profile
+        self.profile_top = profile_top
+        self.encoding = encoding
+        self.use_store = tk.BooleanVar(value=use_store)
         self.root.title("VBA Exporter (VBA Logic)")
         self.root.geometry("700x500")
 
         # --- ▼ [手順3] VbaFormatterをインスタンス化 ▼ ---
         self.formatter = VbaFormatter()
+        self.backend = get_automation_backend()
 
         self.log_area = scrolledtext.ScrolledText(
             root, wrap=tk.WORD, font=("Meiryo UI", 9)
@@ -123,61 +1456,70 @@ class VbaExporterApp:
         )
         self.run_button.pack(pady=10)
 
+        self.store_check = tk.Checkbutton(
+            root,
+            text="重複排除ストアに出力 (同一モジュールを1度だけ保存し、ブックごとに対応表を作成)",
+            variable=self.use_store,
+        )
+        self.store_check.pack(pady=(0, 10))
+
         sys.stdout = self.RedirectText(self.log_area)
         sys.stderr = self.RedirectText(self.log_area)
-    
-    # --- ▼ [手順2] 古いフォーマット関連メソッドを削除 ▼ ---
-    # _get_judgement_line と format_vba_indent はここから削除されました。
-    
+
     def start_export_thread(self):
         """処理を別スレッドで開始する"""
         self.run_button.config(state=tk.DISABLED)
         self.log_area.delete("1.0", tk.END)
 
-        thread = threading.Thread(target=self.run_export_process)
+        thread = threading.Thread(target=self.run_export_thread)
         thread.daemon = True
         thread.start()
 
+    def run_export_thread(self):
+        """エクスポート処理を実行する"""
+        try:
+            self.run_export_process()
+        finally:
+            self.run_button.config(state=tk.NORMAL)
+
     def run_export_process(self):
-        """メインのエクスポート処理"""
+        """
+        メインのエクスポート処理。--profile 指定時はエクスポートのみを計測し、
+        ファイル選択ダイアログの操作を待つ時間は計測に含めない
+        """
         print("ファイル選択ダイアログを開きます...")
         selected_files = self.select_files()
 
         if not selected_files:
             print("ファイルが選択されなかったため、処理を中断しました。")
-            self.run_button.config(state=tk.NORMAL)
+            return
+        try:
+            check_output_folder_conflicts(selected_files)
+        except OutputFolderConflictError as e:
+            print(f"[エラー] 出力先フォルダが重複するため、処理を中断しました: {e}")
             return
 
-        print("VBAエクスポート処理を開始します...")
-
-        if getattr(sys, "frozen", False) and hasattr(sys, "_MEIPASS"):
-            base_dir = os.path.dirname(sys.executable)
+        output_dir = os.path.join(get_base_dir(), OUTPUT_BASE_FOLDER)
+        engine = VbaExportEngine(
+            output_dir,
+            progress=self.print_progress,
+            use_store=self.use_store.get(),
+            formatter=self.formatter,
+            backend=self.backend,
+            encoding=self.encoding,
+        )
+        if self.profile:
+            run_with_profile(
+                lambda: engine.export_workbooks(selected_files), output_dir, self.profile_top
+            )
         else:
-            base_dir = os.path.dirname(os.path.abspath(__file__))
-
-        output_dir = os.path.join(base_dir, OUTPUT_BASE_FOLDER)
-
-        all_success = True
-        for excel_filepath in selected_files:
-            if not os.path.isfile(excel_filepath):
-                print(f"[警告] 指定されたファイルが見つかりません: {excel_filepath}")
-                all_success = False
-                continue
-
-            print(f"\nファイルを処理中: {excel_filepath}")
-
-            excel_filename = os.path.basename(excel_filepath)
-            output_folder_name = os.path.splitext(excel_filename)[0]
-            output_folder_path = os.path.join(output_dir, output_folder_name)
-
-            if not self.export_vba_from_file(excel_filepath, output_folder_path):
-                all_success = False
-
-        print("\nすべての処理が完了しました。")
-        if not all_success:
-            print("いくつかのファイルでエラーが発生しました。詳細は上記のログを確認してください。")
+            engine.export_workbooks(selected_files)
 
-        self.run_button.config(state=tk.NORMAL)
+    def print_progress(self, event):
+        """進捗イベントをログ領域に表示する"""
+        message = format_progress_message(event)
+        if message is not None:
+            print(message, file=sys.stderr if event["event"] == "quit_warning" else sys.stdout)
 
     def select_files(self):
         """ファイル選択ダイアログを表示する"""
@@ -187,54 +1529,6 @@ class VbaExporterApp:
         )
         return file_paths
 
-    def export_vba_from_file(self, excel_filepath, output_folder):
-        """指定されたExcelファイルからVBAコードをエクスポートする"""
-        excel = None
-        try:
-            excel = win32com.client.Dispatch("Excel.Application")
-            excel.Visible = False
-            workbook = excel.Workbooks.Open(excel_filepath)
-
-            print(f"  [処理中] {os.path.basename(excel_filepath)}")
-            os.makedirs(output_folder, exist_ok=True)
-
-            for component in workbook.VBProject.VBComponents:
-                ext = VB_COMPONENT_TYPE.get(component.Type)
-                if not ext:
-                    continue
-                output_filename = f"{component.Name}{ext}"
-                output_filepath = os.path.join(output_folder, output_filename)
-
-                if component.CodeModule.CountOfLines > 0:
-                    original_code = component.CodeModule.Lines(
-                        1, component.CodeModule.CountOfLines
-                    )
-                    
-                    try:
-                        #print(f"    - Formatting {component.Name}...")
-                        # --- ▼ [手順4] 新しいフォーマッターを呼び出す ▼ ---
-                        formatted_code = self.formatter.format_code(original_code)
-                        #print(f"    - {component.Name} のインデント整形完了")
-                    except Exception as e:
-                        print(f"    - [警告] {component.Name} のインデント整形に失敗: {e}")
-                        formatted_code = original_code
-
-                    with open(output_filepath, "w", encoding="utf-8") as f:
-                        f.write(formatted_code)
-
-            workbook.Close(SaveChanges=False)
-            print(f"  [完了] {os.path.basename(excel_filepath)}")
-            return True
-        except Exception as e:
-            print(f"  [エラー] {os.path.basename(excel_filepath)} の処理中にエラーが発生: {e}")
-            return False
-        finally:
-            if excel:
-                try:
-                    excel.Quit()
-                except Exception as e:
-                    print(f"  [警告] Excelの終了処理中にエラーが発生しました: {e}", file=sys.stderr)
-
     # --- ▼ [手順5] 重複していたRedirectTextを削除し、1つに整理 ▼ ---
     class RedirectText:
         """printの出力をTextウィジェットにリダイレクトする"""
@@ -249,7 +1543,263 @@ class VbaExporterApp:
             pass
 
 
+def collect_input_paths(inputs, list_file=None):
+    """
+    パス・globパターン・フォルダ・リストファイルから、処理対象のブックの一覧を作成する。
+    フォルダを指定した場合は直下のExcelファイルを対象とする。重複は除外し、順序は維持する。
+    出力先フォルダはブックのファイル名で決まるため、別のフォルダにある同名のブック
+    （再帰globで一致した a/Book1.xlsm と b/Book1.xlsm 等）が含まれる場合は、
+    互いの出力を上書きしないようOutputFolderConflictErrorを送出する。
+    """
+    patterns = list(inputs)
+    if list_file:
+        with open(list_file, encoding="utf-8-sig") as f:
+            patterns += [
+                line.strip() for line in f if line.strip() and not line.startswith("#")
+            ]
+
+    paths = []
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern, recursive=True))
+        elif os.path.isdir(pattern):
+            matches = sorted(
+                os.path.join(pattern, name)
+                for name in os.listdir(pattern)
+                if name.lower().endswith(EXCEL_FILE_EXTENSIONS)
+            )
+        else:
+            matches = [pattern]
+        for path in matches:
+            # Excelが作成するロックファイル(~$Book1.xlsm)は対象外
+            if os.path.basename(path).startswith("~$"):
+                continue
+            paths.append(os.path.abspath(path))
+    paths = list(dict.fromkeys(paths))
+    check_output_folder_conflicts(paths)
+    return paths
+
+
+def check_output_folder_conflicts(excel_filepaths):
+    """
+    出力先フォルダが重複するブック（フォルダの異なる同名のブックや、Book1.xlsmとBook1.xlsb）が
+    あればOutputFolderConflictErrorを送出する。フォルダ名の大文字・小文字はOSに合わせて区別する。
+    """
+    folders = {}
+    for path in excel_filepaths:
+        folder_name = get_output_folder_name(path)
+        folders.setdefault(os.path.normcase(folder_name), (folder_name, []))[1].append(path)
+    conflicts = {
+        folder_name: folder_paths
+        for folder_name, folder_paths in folders.values()
+        if len(folder_paths) > 1
+    }
+    if conflicts:
+        raise OutputFolderConflictError(conflicts)
+
+
+def run_headless(args):
+    """
+    GUIを使わずにエクスポートを実行し、終了コードを返す。
+    進捗は1行1イベントのJSON(NDJSON)として標準出力または--progress-fileに出力する。
+    """
+    progress_file = None
+    if args.progress_file:
+        progress_file = open(args.progress_file, "w", encoding="utf-8")
+    output = progress_file or sys.stdout
+
+    def write_event(event):
+        output.write(json.dumps(event, ensure_ascii=False) + "\n")
+        output.flush()
+
+    try:
+        try:
+            excel_filepaths = collect_input_paths(args.inputs, args.list_file)
+        except OutputFolderConflictError as e:
+            write_event({"event": "error", "error": str(e), "conflicts": e.conflicts})
+            return EXIT_USAGE_ERROR
+        except OSError as e:
+            write_event({"event": "error", "error": str(e)})
+            return EXIT_USAGE_ERROR
+        if not excel_filepaths:
+            write_event({"event": "error", "error": "no input workbooks"})
+            return EXIT_USAGE_ERROR
+
+        output_dir = args.output or os.path.join(get_base_dir(), OUTPUT_BASE_FOLDER)
+        engine = VbaExportEngine(
+            output_dir,
+            progress=write_event,
+            use_store=args.store,
+            jobs=args.jobs,
+            encoding=args.encoding,
+        )
+        if args.profile:
+            failed = run_with_profile(
+                lambda: engine.export_workbooks(excel_filepaths),
+                output_dir,
+                args.profile_top,
+                out=sys.stderr,
+            )
+        else:
+            failed = engine.export_workbooks(excel_filepaths)
+        return EXIT_EXPORT_FAILED if failed else EXIT_OK
+    finally:
+        if progress_file:
+            progress_file.close()
+
+
+def run_compare(args):
+    """
+    --compareで指定された2つのブック・エクスポート済みフォルダを比較し、終了コードを返す。
+    差分はNDJSON(--report ndjson)またはテキスト(--report text)で出力する。
+    """
+    progress_file = None
+    if args.progress_file:
+        progress_file = open(args.progress_file, "w", encoding="utf-8")
+    output = progress_file or sys.stdout
+
+    def write_event(event):
+        if args.report == "text":
+            message = format_progress_message(event)
+            if message is None:
+                return
+            output.write(message + "\n")
+        else:
+            output.write(json.dumps(event, ensure_ascii=False) + "\n")
+        output.flush()
+
+    try:
+        for path in args.compare:
+            if not os.path.exists(path):
+                write_event({"event": "error", "error": f"not found: {path}"})
+                return EXIT_USAGE_ERROR
+        engine = VbaExportEngine(get_base_dir(), progress=write_event, encoding=args.encoding)
+        try:
+            changed = engine.compare(*args.compare)
+        except Exception as e:
+            write_event({"event": "error", "error": str(e)})
+            return EXIT_USAGE_ERROR
+        return EXIT_DIFFERENCES_FOUND if changed else EXIT_OK
+    finally:
+        if progress_file:
+            progress_file.close()
+
+
+def parse_arguments(argv):
+    """実行時引数を解析する"""
+    parser = argparse.ArgumentParser(prog=os.path.basename(sys.argv[0]))
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="エクスポート処理をcProfileで計測し、結果を出力フォルダに保存する",
+    )
+    parser.add_argument(
+        "--profile-top",
+        type=int,
+        default=PROFILE_TOP_N,
+        help="表示する上位関数の件数",
+    )
+    parser.add_argument(
+        "--store",
+        action="store_true",
+        help="重複排除ストアに出力する（GUIではチェックボックスの初期値）",
+    )
+    parser.add_argument(
+        "--headless",
+        action="store_true",
+        help="GUIを表示せずにエクスポートし、進捗をNDJSONで出力する",
+    )
+    parser.add_argument(
+        "inputs",
+        nargs="*",
+        help="ヘッドレス: 対象のブックのパス・globパターン・フォルダ",
+    )
+    parser.add_argument(
+        "--list-file",
+        default=None,
+        help="ヘッドレス: 対象のブックのパスを1行に1つ記述したファイル",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="ヘッドレス: 並列に処理するブックの数（並列数だけExcelを起動し、ブック間で使い回す）",
+    )
+    parser.add_argument(
+        "--output",
+        default=None,
+        help=f"ヘッドレス: 出力先フォルダ（既定は実行ファイルと同じ場所の {OUTPUT_BASE_FOLDER}）",
+    )
+    parser.add_argument(
+        "--progress-file",
+        default=None,
+        help="ヘッドレス: 進捗のNDJSONを標準出力の代わりに書き込むファイル",
+    )
+    parser.add_argument(
+        "--encoding",
+        default=SOURCE_ENCODING,
+        help=f"出力するモジュールの文字コード（既定は {SOURCE_ENCODING}）。読み込み時は自動判定の既定値",
+    )
+    parser.add_argument(
+        "--compare",
+        nargs=2,
+        metavar=("LEFT", "RIGHT"),
+        default=None,
+        help="2つのブックまたはエクスポート済みフォルダを手続き単位で比較する（GUIは表示しない）",
+    )
+    parser.add_argument(
+        "--report",
+        choices=("ndjson", "text"),
+        default="ndjson",
+        help="比較: 差分の出力形式",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=("win32com", "simulator"),
+        default=None,
+        help="オートメーションバックエンド（simulatorはpywin32無しで動作する）",
+    )
+    parser.add_argument(
+        "--sim-call-ms",
+        type=float,
+        default=0.0,
+        help="シミュレーター: COM呼び出し1回あたりの遅延(ms)",
+    )
+    parser.add_argument(
+        "--sim-line-ms",
+        type=float,
+        default=0.0,
+        help="シミュレーター: 転送する1行あたりの遅延(ms)",
+    )
+    # 誤ったオプションを無視して無人実行を続けないよう、未知の引数はエラー(終了コード2)とする
+    args = parser.parse_args(argv)
+    try:
+        codecs.lookup(args.encoding)
+    except LookupError:
+        parser.error(f"unknown encoding: {args.encoding}")
+    return args
+
+
 if __name__ == "__main__":
+    # format_manyのワーカープロセスを、実行ファイル化した環境でも起動できるようにする
+    multiprocessing.freeze_support()
+    args = parse_arguments(sys.argv[1:])
+    if args.backend == "simulator":
+        set_automation_backend(SimulatedExcelBackend(args.sim_call_ms, args.sim_line_ms))
+    elif args.backend == "win32com":
+        set_automation_backend(Win32ComBackend())
+
+    if args.compare:
+        sys.exit(run_compare(args))
+    if args.headless:
+        sys.exit(run_headless(args))
+
     root = tk.Tk()
-    app = VbaExporterApp(root)
+    app = VbaExporterApp(
+        root,
+        profile=args.profile,
+        profile_top=args.profile_top,
+        use_store=args.store,
+        encoding=args.encoding,
+    )
     root.mainloop()
\ No newline at end of file